@@ -0,0 +1,161 @@
+from functools import cached_property
+import numpy as np
+from db import db, TestCase, TestRun, TestResult
+from utils import LRUCache, code_with_prefix
+
+STATUS_CODES = {'pass': 1, 'fail': 2, 'skip': 3}
+STATUS_NAMES = ('', 'pass', 'fail', 'skip')
+DURATION_PERCENTILES = (50, 90)
+HISTORY_CHUNK_SIZE = 10000
+HISTORY_CACHE_SIZE = 16
+HISTORY_CACHE_TTL = 60
+history_cache = LRUCache(HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL)
+
+def ratio(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.full(len(numerator), np.nan), where=denominator > 0)
+
+class SuiteHistory:
+    def __init__(self, run_ids, run_dates, case_ids, runs, cases, statuses, durations):
+        self.run_ids = run_ids
+        self.run_dates = run_dates
+        self.case_ids = case_ids
+        self.runs = runs
+        self.cases = cases
+        self.statuses = statuses
+        self.durations = durations
+
+    def matrix(self, last=None):
+        start = 0 if last is None else max(len(self.run_ids) - last, 0)
+        matrix = np.zeros((len(self.run_ids) - start, len(self.case_ids)), dtype=np.int8)
+        selected = self.runs >= start
+        matrix[self.runs[selected] - start, self.cases[selected]] = self.statuses[selected]
+        return matrix
+
+    def duration_percentiles(self, executions):
+        total = len(self.case_ids)
+        if not len(self.durations):
+            return {percentile: np.full(total, np.nan) for percentile in DURATION_PERCENTILES}
+        span = int(self.durations.max()) + 1
+        durations = (np.sort(self.cases * span + self.durations) % span).astype(float)
+        starts = np.cumsum(executions) - executions
+        percentiles = {}
+        for percentile in DURATION_PERCENTILES:
+            position = starts + np.maximum(executions - 1, 0) * percentile / 100
+            low = np.floor(position).astype(np.int64).clip(0, len(durations) - 1)
+            high = np.ceil(position).astype(np.int64).clip(0, len(durations) - 1)
+            value = durations[low] + (durations[high] - durations[low]) * (position - low)
+            percentiles[percentile] = np.where(executions > 0, value, np.nan)
+        return percentiles
+
+    @cached_property
+    def metrics(self):
+        total = len(self.case_ids)
+        count = lambda mask: np.bincount(self.cases[mask], minlength=total)
+        executions = np.bincount(self.cases, minlength=total)
+        passes = count(self.statuses == STATUS_CODES['pass'])
+        failures = count(self.statuses == STATUS_CODES['fail'])
+        decided = passes + failures
+        order = np.argsort(self.cases * len(self.run_ids) + self.runs)
+        order = order[self.statuses[order] != STATUS_CODES['skip']]
+        cases = self.cases[order]
+        statuses = self.statuses[order]
+        flipped = (cases[1:] == cases[:-1]) & (statuses[1:] != statuses[:-1])
+        flips = np.bincount(cases[1:][flipped], minlength=total)
+        last_failure = np.full(total, -1, dtype=np.int64)
+        failed = self.statuses == STATUS_CODES['fail']
+        np.maximum.at(last_failure, self.cases[failed], self.runs[failed])
+        return {
+            'executions': executions,
+            'passes': passes,
+            'failures': failures,
+            'pass_rate': ratio(passes, decided),
+            'flips': flips,
+            'flip_rate': ratio(flips, decided - 1),
+            'last_failure': last_failure,
+            'runs_since_failure': np.where(last_failure >= 0, len(self.run_ids) - 1 - last_failure, -1),
+            'duration': self.duration_percentiles(executions)
+        }
+
+    def summary(self, metrics):
+        decided = int(metrics['passes'].sum() + metrics['failures'].sum())
+        return {
+            'runs': len(self.run_ids),
+            'analyzed_testcases': len(self.case_ids),
+            'results': len(self.statuses),
+            'pass_rate': round(int(metrics['passes'].sum()) / decided * 100, 2) if decided else 0,
+            'flaky_testcases': int(np.count_nonzero(metrics['flips']))
+        }
+
+    def flaky_order(self, metrics):
+        return np.lexsort((np.nan_to_num(metrics['pass_rate'], nan=2.0), -np.nan_to_num(metrics['flip_rate'], nan=-1.0)))
+
+def history_version(testsuite_id):
+    return tuple(db.session.execute(
+        db.select(db.func.count(TestRun.id), db.func.max(TestRun.updated_at)).filter_by(test_suite_id=testsuite_id)
+    ).one())
+
+def load_history(testsuite_id):
+    runs = db.session.execute(
+        db.select(TestRun.id, TestRun.created_at).filter_by(test_suite_id=testsuite_id).order_by(TestRun.created_at.asc(), TestRun.id.asc())
+    ).all()
+    run_ids = np.array([id for id, _ in runs], dtype=np.int64)
+    result = db.session.execute(
+        db.select(TestResult.test_run_id, TestResult.test_case_id, db.case(STATUS_CODES, value=TestResult.status), db.func.coalesce(TestResult.duration, 0))
+        .join(TestRun).filter(TestRun.test_suite_id == testsuite_id, TestResult.executed_at.is_not(None))
+        .execution_options(yield_per=HISTORY_CHUNK_SIZE)
+    )
+    chunks = [np.array(partition, dtype=np.int64) for partition in result.partitions()]
+    results = np.concatenate(chunks) if chunks else np.empty((0, 4), dtype=np.int64)
+    run_order = np.argsort(run_ids)
+    case_ids, cases = np.unique(results[:, 1], return_inverse=True)
+    return SuiteHistory(
+        run_ids,
+        [created_at for _, created_at in runs],
+        case_ids,
+        run_order[np.searchsorted(run_ids, results[:, 0], sorter=run_order)],
+        cases.reshape(-1),
+        results[:, 2].astype(np.int8),
+        results[:, 3]
+    )
+
+def suite_history(testsuite_id):
+    version = history_version(testsuite_id)
+    cached = history_cache.get(testsuite_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    history = load_history(testsuite_id)
+    history_cache.set(testsuite_id, (version, history))
+    return history
+
+def testcase_labels(case_ids):
+    if not len(case_ids):
+        return {}
+    rows = db.session.execute(db.select(TestCase.id, TestCase.order, TestCase.title).filter(TestCase.id.in_(case_ids.tolist())))
+    return {id: (code_with_prefix('TC', order), title) for id, order, title in rows}
+
+def metric_rows(history, metrics, indexes, recent=None):
+    labels = testcase_labels(history.case_ids[indexes])
+    optional = lambda value, digits=2: None if np.isnan(value) else round(float(value), digits)
+    rows = []
+    for index in indexes:
+        case_id = int(history.case_ids[index])
+        if case_id not in labels:
+            continue
+        last_failure = int(metrics['last_failure'][index])
+        rows.append({
+            'test_case_id': case_id,
+            'code': labels[case_id][0],
+            'title': labels[case_id][1],
+            'executions': int(metrics['executions'][index]),
+            'passes': int(metrics['passes'][index]),
+            'failures': int(metrics['failures'][index]),
+            'pass_rate': optional(metrics['pass_rate'][index] * 100),
+            'flips': int(metrics['flips'][index]),
+            'flip_rate': optional(metrics['flip_rate'][index] * 100),
+            'runs_since_failure': int(metrics['runs_since_failure'][index]) if last_failure >= 0 else None,
+            'last_failure_at': history.run_dates[last_failure] if last_failure >= 0 else None,
+            **{f'duration_p{percentile}': optional(values[index], 1) for percentile, values in metrics['duration'].items()}
+        })
+        if recent is not None:
+            rows[-1]['recent'] = [STATUS_NAMES[status] for status in recent[:, index]]
+    return rows
@@ -0,0 +1,75 @@
+import logging
+from logging.handlers import SMTPHandler
+import time
+from flask import Flask, render_template
+from flask_migrate import Migrate
+from jinja2 import FileSystemBytecodeCache
+from db import db
+from decorators import LazyGlobals
+from explain import explain_command
+from fragments import init_fragment_cache
+from routes.auth import bp as auth_bp
+from routes.project import bp as project_bp
+from routes.testcase import bp as testcase_bp
+from routes.testsuite import bp as testsuite_bp
+from routes.testrun import bp as testrun_bp
+from routes.requirement import bp as requirement_bp
+from routes.profile import bp as profile_bp
+from routes.member import bp as member_bp
+from routes.bugtracking import bp as bugtracking_bp
+from routes.job import bp as job_bp
+from routes.search import bp as search_bp
+from utils import format_datetime, database_uri
+
+BLUEPRINTS = (auth_bp, project_bp, testcase_bp, testrun_bp, testsuite_bp, requirement_bp, profile_bp, member_bp, bugtracking_bp, job_bp, search_bp)
+
+def index():
+    return render_template('index.html')
+
+def mail_handler():
+    handler = SMTPHandler(
+        mailhost=('maildev', 1025),
+        fromaddr='server-error@example.com',
+        toaddrs=['admin@example.com'],
+        subject='Application Error'
+    )
+    handler.setLevel(logging.ERROR)
+    handler.setFormatter(logging.Formatter(
+        '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
+    ))
+    return handler
+
+def compile_templates(app):
+    for name in app.jinja_env.list_templates(extensions=('html',)):
+        app.jinja_env.get_template(name)
+
+def create_app(config=None):
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.app_ctx_globals_class = LazyGlobals
+    app.config["SECRET_KEY"] = "dev"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["JINJA_BYTECODE_CACHE_DIR"] = None
+    app.config["PRELOAD_TEMPLATES"] = True
+    app.config.from_mapping(config or {})
+    if "SQLALCHEMY_DATABASE_URI" not in app.config:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri("testdb", psswd_file='/run/secrets/db-password')
+
+    for blueprint in BLUEPRINTS:
+        app.register_blueprint(blueprint)
+
+    db.init_app(app)
+    Migrate(app, db)
+    app.cli.add_command(explain_command)
+    app.add_url_rule("/", "index", index)
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["JINJA_BYTECODE_CACHE_DIR"])
+    app.jinja_env.filters['format_datetime'] = format_datetime
+    init_fragment_cache(app)
+    if app.config["PRELOAD_TEMPLATES"]:
+        compile_templates(app)
+
+    if not app.debug and not app.testing:
+        app.logger.addHandler(mail_handler())
+    app.config["STARTUP_SECONDS"] = time.perf_counter() - started
+    return app
@@ -1,10 +1,158 @@
+import base64
 from datetime import datetime
+import json
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.dialects.mysql import ENUM
-from utils import code_with_prefix
+from utils import EXPORT_CHUNK_SIZE, code_with_prefix
 
 db = SQLAlchemy()
 
+PAGE_SIZE = 50
+BUG_PRIORITY_RANK = {'high': 2, 'medium': 1, 'low': 0}
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, keys):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return [datetime.fromisoformat(value) if isinstance(key.type, db.DateTime) else int(value) for (key, _), value in zip(keys, values, strict=True)]
+    except (ValueError, TypeError):
+        return None
+
+def after_cursor(keys, values):
+    conditions = []
+    for index, ((key, descending), value) in enumerate(zip(keys, values)):
+        ties = [k == v for (k, _), v in zip(keys[:index], values[:index])]
+        conditions.append(db.and_(*ties, key < value if descending else key > value))
+    first_key, descending = keys[0]
+    return db.and_(first_key <= values[0] if descending else first_key >= values[0], db.or_(*conditions))
+
+def keyset_statement(statement, keys, values, limit):
+    if values:
+        statement = statement.where(after_cursor(keys, values))
+    statement = statement.add_columns(*(key for key, _ in keys)).order_by(*(key.desc() if descending else key.asc() for key, descending in keys))
+    return statement.limit(limit)
+
+def keyset_page(statement, keys, values, limit):
+    return db.session.execute(keyset_statement(statement, keys, values, limit)).all()
+
+def paginate(statement, keys, cursor=None, per_page=PAGE_SIZE):
+    values = decode_cursor(cursor, keys) if cursor else None
+    rows = keyset_page(statement, keys, values, per_page + 1)
+    next_cursor = encode_cursor(list(rows[per_page - 1][1:])) if len(rows) > per_page else None
+    return [row[0] for row in rows[:per_page]], next_cursor
+
+def iter_keyset(statement, keys, per_page=EXPORT_CHUNK_SIZE):
+    values = None
+    while True:
+        rows = keyset_page(statement, keys, values, per_page)
+        for row in rows:
+            yield row[0]
+        if len(rows) < per_page:
+            return
+        values = list(rows[-1][1:])
+
+def close_gaps(model, orders, **scope):
+    orders = sorted(orders, reverse=True)
+    if not orders:
+        return
+    shift = db.case(*((model.order > order, len(orders) - index) for index, order in enumerate(orders)), else_=0)
+    db.session.execute(
+        db.update(model).filter_by(**scope).where(model.order > orders[-1]).values(order=model.order - shift)
+        .execution_options(synchronize_session=False)
+    )
+
+def reserve_orders(model, project_id, count=1):
+    counter = db.update(ProjectCounter).filter_by(project_id=project_id, entity=model.__tablename__).values(value=ProjectCounter.value + count)
+    if not db.session.execute(counter).rowcount:
+        try:
+            with db.session.begin_nested():
+                last_order = db.session.execute(db.select(db.func.max(model.order)).filter_by(project_id=project_id)).scalar() or 0
+                db.session.add(ProjectCounter(project_id=project_id, entity=model.__tablename__, value=last_order + count))
+        except IntegrityError:
+            db.session.execute(counter)
+    value = db.session.execute(db.select(ProjectCounter.value).filter_by(project_id=project_id, entity=model.__tablename__)).scalar()
+    return value - count + 1
+
+def release_order(model, project_id, order):
+    db.session.execute(db.update(ProjectCounter).filter_by(project_id=project_id, entity=model.__tablename__).values(value=ProjectCounter.value - 1))
+    close_gaps(model, [order], project_id=project_id)
+
+def apply_order(model, ids, **scope):
+    current_ids = db.session.execute(db.select(model.id).filter_by(**scope)).scalars().all()
+    if len(ids) != len(current_ids) or set(ids) != set(current_ids):
+        return False
+    db.session.execute(
+        db.update(model).where(model.id.in_(ids)).values(order=db.case({id: index for index, id in enumerate(ids, 1)}, value=model.id))
+        .execution_options(synchronize_session=False)
+    )
+    return True
+
+def version_statement(*statements):
+    subqueries = [statement.subquery() for statement in statements]
+    statement = db.select(*(column for subquery in subqueries for column in subquery.c)).select_from(subqueries[0])
+    for subquery in subqueries[1:]:
+        statement = statement.join(subquery, db.true())
+    return statement
+
+def change_version(*statements):
+    return tuple(db.session.execute(version_statement(*statements)).one())
+
+def table_version(model, *criteria):
+    marker = model.updated_at if hasattr(model, 'updated_at') else model.id
+    return db.select(db.func.count(), db.func.max(marker)).filter(*criteria)
+
+def project_versions(project_id, *models):
+    parents = {RequirementTestCase: Requirement, BugTestCase: Bug, TestRun: TestSuite, User: ProjectMember}
+    statements = []
+    for model in models:
+        parent = parents.get(model)
+        statement = table_version(model) if parent is None else table_version(model).join(parent)
+        statements.append(statement.filter((parent or model).project_id == project_id))
+    return statements
+
+def stats_expressions(project_id):
+    open_bugs = lambda priority: db.select(db.func.count(Bug.id)).filter(Bug.project_id == project_id, Bug.status != 'closed', Bug.priority == priority).scalar_subquery()
+    return {
+        'total_requirements': db.select(db.func.count(Requirement.id)).filter(Requirement.project_id == project_id).scalar_subquery(),
+        'covered_requirements': db.select(db.func.count(db.distinct(RequirementTestCase.requirement_id))).join(Requirement).filter(Requirement.project_id == project_id).scalar_subquery(),
+        'total_testcases': db.select(db.func.count(TestCase.id)).filter(TestCase.project_id == project_id).scalar_subquery(),
+        'open_bugs_high': open_bugs('high'),
+        'open_bugs_medium': open_bugs('medium'),
+        'open_bugs_low': open_bugs('low'),
+        'last_run_id': db.select(TestRun.id).join(TestSuite).filter(TestSuite.project_id == project_id).order_by(TestRun.created_at.desc(), TestRun.id.desc()).limit(1).scalar_subquery()
+    }
+
+def write_stats(project_id, statement):
+    if db.session.execute(statement).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            values = db.session.execute(db.select(*(expression.label(name) for name, expression in stats_expressions(project_id).items()))).one()
+            db.session.add(ProjectStats(project_id=project_id, **values._asdict()))
+    except IntegrityError:
+        db.session.execute(statement)
+
+def update_stats(project_id, **deltas):
+    values = {name: getattr(ProjectStats, name) + delta for name, delta in deltas.items() if delta}
+    if values:
+        write_stats(project_id, db.update(ProjectStats).filter_by(project_id=project_id).values(values))
+
+def refresh_stats(project_id, *names):
+    expressions = stats_expressions(project_id)
+    write_stats(project_id, db.update(ProjectStats).filter_by(project_id=project_id).values({name: expressions[name] for name in names or expressions}))
+
+def open_bug_delta(status, priority, sign=1):
+    return {} if status == 'closed' else {f'open_bugs_{priority}': sign}
+
+def bug_rank(status, priority):
+    return (0 if status == 'closed' else len(BUG_PRIORITY_RANK)) + BUG_PRIORITY_RANK[priority]
+
+def bug_rank_expression():
+    return db.case((Bug.status == 'closed', 0), else_=len(BUG_PRIORITY_RANK)) + db.case(BUG_PRIORITY_RANK, value=Bug.priority, else_=0)
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
@@ -26,12 +174,19 @@ class Project(db.Model):
     test_cases = db.relationship('TestCase', backref='project', lazy=True, cascade="all, delete-orphan")
     test_suites = db.relationship('TestSuite', backref='project', lazy=True, cascade="all, delete-orphan")
     bugs = db.relationship('Bug', backref='project', lazy=True, cascade="all, delete-orphan")
+    manager_user = db.relationship('User', lazy=True)
+    counters = db.relationship('ProjectCounter', lazy=True, cascade="all, delete-orphan")
+    stats = db.relationship('ProjectStats', uselist=False, lazy=True, cascade="all, delete-orphan")
 
     @property
     def manager(self):
-        return db.session.execute(db.select(User.name).filter_by(id=self.manager_id)).scalar()
+        return self.manager_user.name if self.manager_user else None
 
 class ProjectMember(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'project_id', name='uq_project_member_user_id_project_id'),
+        db.Index('ix_project_member_project_id', 'project_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.ForeignKey('project.id'))
     user_id = db.Column(db.ForeignKey('user.id'))
@@ -40,13 +195,41 @@ class ProjectMember(db.Model):
 
     @property
     def name(self):
-        return db.session.execute(db.select(User.name).filter_by(id=self.user_id)).scalar()
+        return self.member.name if self.member else None
 
     @property
     def email(self):
-        return db.session.execute(db.select(User.email).filter_by(id=self.user_id)).scalar()
+        return self.member.email if self.member else None
+
+class ProjectCounter(db.Model):
+    project_id = db.Column(db.ForeignKey('project.id'), primary_key=True)
+    entity = db.Column(ENUM('requirement', 'test_case', 'bug'), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class ProjectStats(db.Model):
+    project_id = db.Column(db.ForeignKey('project.id'), primary_key=True)
+    total_requirements = db.Column(db.Integer, nullable=False, default=0)
+    covered_requirements = db.Column(db.Integer, nullable=False, default=0)
+    total_testcases = db.Column(db.Integer, nullable=False, default=0)
+    open_bugs_high = db.Column(db.Integer, nullable=False, default=0)
+    open_bugs_medium = db.Column(db.Integer, nullable=False, default=0)
+    open_bugs_low = db.Column(db.Integer, nullable=False, default=0)
+    last_run_id = db.Column(db.Integer, default=None)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    @property
+    def open_bugs(self):
+        return self.open_bugs_high + self.open_bugs_medium + self.open_bugs_low
+
+    @property
+    def percent_covered(self):
+        return round(self.covered_requirements / self.total_requirements * 100, 2) if self.total_requirements else 0
 
 class Requirement(db.Model):
+    __table_args__ = (
+        db.Index('ix_requirement_project_id_order', 'project_id', 'order'),
+        db.Index('ix_requirement_search', 'title', 'description', mysql_prefix='FULLTEXT'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.String(500), default=None)
@@ -62,12 +245,11 @@ class Requirement(db.Model):
     def code_with_prefix(self):
         return code_with_prefix("REQ", self.order)
 
-    @property
-    def last_order(self):
-        last_req_order = db.session.execute(db.select(Requirement.order).filter_by(project_id=self.project_id).order_by(Requirement.order.desc()).limit(1)).scalars().first()
-        return last_req_order or 0
-
 class TestCase(db.Model):
+    __table_args__ = (
+        db.Index('ix_test_case_project_id_order', 'project_id', 'order'),
+        db.Index('ix_test_case_search', 'title', 'preconditions', 'steps', 'expected_result', mysql_prefix='FULLTEXT'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     preconditions = db.Column(db.String(200), nullable=False)
@@ -81,6 +263,8 @@ class TestCase(db.Model):
     bug_associations = db.relationship('BugTestCase', backref='test_case', lazy=True, cascade="all, delete-orphan")
     testsuite_associations = db.relationship('TestSuiteCase', backref='test_case', lazy=True, cascade="all, delete-orphan")
     testresults_associations = db.relationship('TestResult', backref='test_case', lazy=True, cascade="all, delete-orphan")
+    requirements = db.relationship('Requirement', secondary='requirement_test_case', order_by='Requirement.order', lazy=True, viewonly=True)
+    bugs = db.relationship('Bug', secondary='bug_test_case', order_by='Bug.order', lazy=True, viewonly=True)
 
     @property
     def code_with_prefix(self):
@@ -88,24 +272,25 @@ class TestCase(db.Model):
 
     @property
     def requirements_codes(self):
-        reqs_orders = db.session.execute(db.select(Requirement.order).join(RequirementTestCase).filter(RequirementTestCase.test_case_id == self.id)).scalars().all()
-        return [code_with_prefix("REQ", order) for order in reqs_orders]
-
-    @property
-    def last_order(self):
-        last_tc_order = db.session.execute(db.select(TestCase.order).filter_by(project_id=self.project_id).order_by(TestCase.order.desc()).limit(1)).scalars().first()
-        return last_tc_order or 0
+        return [code_with_prefix("REQ", req.order) for req in self.requirements]
 
     @property
     def open_bugs(self):
-        return db.session.execute(db.select(Bug).join(BugTestCase).filter(BugTestCase.test_case_id == self.id, Bug.status != 'closed')).scalars().all()
+        return [bug for bug in self.bugs if bug.status != 'closed']
 
 class RequirementTestCase(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('requirement_id', 'test_case_id', name='uq_requirement_test_case_requirement_id_test_case_id'),
+        db.Index('ix_requirement_test_case_test_case_id', 'test_case_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     requirement_id = db.Column(db.ForeignKey('requirement.id'))
     test_case_id = db.Column(db.ForeignKey('test_case.id'))
 
 class TestSuite(db.Model):
+    __table_args__ = (
+        db.Index('ix_test_suite_project_id_created_at', 'project_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
     description = db.Column(db.String(500), default=None)
@@ -116,6 +301,11 @@ class TestSuite(db.Model):
     testruns = db.relationship('TestRun', backref='test_suite', lazy=True, cascade="all, delete-orphan")
 
 class TestSuiteCase(db.Model):
+    __table_args__ = (
+        db.Index('ix_test_suite_case_test_suite_id_order', 'test_suite_id', 'order'),
+        db.UniqueConstraint('test_suite_id', 'test_case_id', name='uq_test_suite_case_test_suite_id_test_case_id'),
+        db.Index('ix_test_suite_case_test_case_id', 'test_case_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     test_suite_id = db.Column(db.ForeignKey('test_suite.id'))
     test_case_id = db.Column(db.ForeignKey('test_case.id'))
@@ -123,60 +313,69 @@ class TestSuiteCase(db.Model):
 
     @property
     def testcase_code(self):
-        tc_order = db.session.execute(db.select(TestCase.order).filter_by(id=self.test_case_id)).scalar()
-        return code_with_prefix("TC", tc_order)
+        return code_with_prefix("TC", self.test_case.order)
 
     @property
     def testcase_title(self):
-        return db.session.execute(db.select(TestCase.title).filter_by(id=self.test_case_id)).scalar()
+        return self.test_case.title
 
 class TestRun(db.Model):
+    __table_args__ = (
+        db.Index('ix_test_run_test_suite_id_created_at', 'test_suite_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     test_suite_id = db.Column(db.ForeignKey('test_suite.id'))
     created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    total_results = db.Column(db.Integer, default=0)
+    total_executed = db.Column(db.Integer, default=0)
+    total_passed = db.Column(db.Integer, default=0)
+    total_failed = db.Column(db.Integer, default=0)
+    total_skipped = db.Column(db.Integer, default=0)
+    duration = db.Column(db.Integer, default=0)
+    is_finished = db.Column(db.Boolean, default=False)
     testresults = db.relationship('TestResult', backref='test_run', lazy=True, cascade="all, delete-orphan")
 
     @property
-    def duration(self):
-        return db.session.execute(db.select(db.func.sum(TestResult.duration)).filter(TestResult.test_run_id == self.id, TestResult.executed_at != None)).scalar()
-
-    @property
-    def total_executed(self):
-        return db.session.execute(db.select(db.func.count()).select_from(TestResult).filter(TestResult.test_run_id == self.id, TestResult.executed_at != None)).scalar()
-
-    @property
-    def total_results(self):
-        return db.session.execute(db.select(db.func.count()).select_from(TestResult).filter_by(test_run_id=self.id)).scalar()
-    
-    @property
-    def is_finished(self):
-        trs = db.session.execute(db.select(TestResult.executed_at).filter_by(test_run_id=self.id)).scalars()
-        return all(trs)
+    def percent_passed(self):
+        return round(self.total_passed / self.total_results * 100, 2) if self.total_results else 0
 
 class TestResult(db.Model):
+    __table_args__ = (
+        db.Index('ix_test_result_test_run_id_executed_at_position', 'test_run_id', 'executed_at', 'position'),
+        db.Index('ix_test_result_test_case_id_executed_at', 'test_case_id', 'executed_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     test_run_id = db.Column(db.ForeignKey('test_run.id'))
     test_case_id = db.Column(db.ForeignKey('test_case.id'))
+    position = db.Column(db.Integer, default=0)
     executed_by = db.Column(db.ForeignKey('user.id'))
     status = db.Column(ENUM('pass', 'fail', 'skip'), nullable=False)
     executed_at = db.Column(db.DateTime)
     notes = db.Column(db.String(200))
     duration = db.Column(db.Integer)
+    executor_user = db.relationship('User', lazy=True)
 
     @property
     def testcase_code(self):
-        order = db.session.execute(db.select(TestCase.order).filter_by(id=self.test_case_id)).scalar()
-        return code_with_prefix("TC", order)
+        return code_with_prefix("TC", self.test_case.order)
 
     @property
     def testcase_title(self):
-        return db.session.execute(db.select(TestCase.title).filter_by(id=self.test_case_id)).scalar()
+        return self.test_case.title
 
     @property
     def executor(self):
-        return db.session.execute(db.select(User.name).filter_by(id=self.executed_by)).scalar()
+        return self.executor_user.name if self.executor_user else None
 
 class Bug(db.Model):
+    __table_args__ = (
+        db.Index('ix_bug_project_id_order', 'project_id', 'order'),
+        db.Index('ix_bug_project_id_created_at', 'project_id', 'created_at'),
+        db.Index('ix_bug_project_id_status_priority', 'project_id', 'status', 'priority'),
+        db.Index('ix_bug_project_id_board_rank_created_at', 'project_id', 'board_rank', 'created_at', 'id'),
+        db.Index('ix_bug_search', 'title', 'description', mysql_prefix='FULLTEXT'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80), nullable=False)
     description = db.Column(db.String(200), default=None)
@@ -185,29 +384,54 @@ class Bug(db.Model):
     status = db.Column(ENUM('open', 'progress', 'closed'), nullable=False)
     priority = db.Column(ENUM('high', 'medium', 'low'), nullable=False)
     order = db.Column(db.Integer, default=0)
+    board_rank = db.Column(db.SmallInteger, nullable=False, default=0)
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     testcase_associations = db.relationship('BugTestCase', backref='bug', lazy=True, cascade="all, delete-orphan")
+    test_cases = db.relationship('TestCase', secondary='bug_test_case', order_by='TestCase.order', lazy=True, viewonly=True)
+    reporter_user = db.relationship('User', lazy=True)
 
     @property
     def code_with_prefix(self):
         return code_with_prefix("BUG", self.order)
 
-    @property
-    def last_order(self):
-        last_bug_order = db.session.execute(db.select(Bug.order).filter_by(project_id=self.project_id).order_by(Bug.order.desc()).limit(1)).scalars().first()
-        return last_bug_order or 0
-
     @property
     def testcases_codes(self):
-        tcs_orders = db.session.execute(db.select(TestCase.order).join(BugTestCase).filter(BugTestCase.bug_id == self.id)).scalars().all()
-        return [code_with_prefix("TC", order) for order in tcs_orders]
+        return [code_with_prefix("TC", tc.order) for tc in self.test_cases]
 
     @property
     def reporter(self):
-        return db.session.execute(db.select(User.name).filter_by(id=self.reported_by)).scalar()
+        return self.reporter_user.name if self.reporter_user else None
 
 class BugTestCase(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('bug_id', 'test_case_id', name='uq_bug_test_case_bug_id_test_case_id'),
+        db.Index('ix_bug_test_case_test_case_id', 'test_case_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     bug_id = db.Column(db.ForeignKey('bug.id'))
     test_case_id = db.Column(db.ForeignKey('test_case.id'))
+
+class Job(db.Model):
+    __table_args__ = (
+        db.Index('ix_job_status_id', 'status', 'id'),
+        db.Index('ix_job_user_id_created_at', 'user_id', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(ENUM('import', 'export', 'delete'), nullable=False)
+    status = db.Column(ENUM('queued', 'running', 'finished', 'failed'), nullable=False, default='queued')
+    user_id = db.Column(db.ForeignKey('user.id'))
+    project_id = db.Column(db.Integer)
+    payload = db.Column(db.JSON, default=dict)
+    progress = db.Column(db.Integer, default=0)
+    message = db.Column(db.String(500))
+    result_path = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    @property
+    def is_done(self):
+        return self.status in ('finished', 'failed')
@@ -1,11 +1,60 @@
+from datetime import datetime, timedelta
 import functools
-from flask import g, redirect, url_for, flash, request
-from db import db, Project, ProjectMember
+import hashlib
+import time
+from flask import g, redirect, url_for, flash, request, session, has_request_context, make_response
+from flask.ctx import _AppCtxGlobals
+from db import db, change_version, Project, ProjectMember, User
+
+ROLE_CACHE_TTL = 30
+ROLE_CACHE_SIZE = 10000
+VERSION_SETTLE_TIME = timedelta(seconds=1)
+role_cache = {}
+
+def session_value(key):
+    return session.get(key) if has_request_context() else None
+
+class LazyGlobals(_AppCtxGlobals):
+    loaders = {
+        'user_id': lambda: session_value('user_id'),
+        'project_id': lambda: session_value('project_id'),
+        'user': lambda: db.session.get(User, g.user_id) if g.user_id is not None else None,
+        'project': lambda: db.session.get(Project, g.project_id) if g.project_id is not None else None
+    }
+
+    def __getattr__(self, name):
+        loader = self.loaders.get(name)
+        if loader is None:
+            raise AttributeError(name)
+        value = loader()
+        setattr(self, name, value)
+        return value
+
+def get_role(user_id, project_id):
+    key = (user_id, project_id)
+    roles = g.setdefault('roles', {})
+    if key not in roles:
+        role, expires_at = role_cache.get(key, (None, 0))
+        if expires_at < time.monotonic():
+            role = db.session.execute(
+                db.select(ProjectMember.role).filter_by(user_id=user_id, project_id=project_id)
+            ).scalar()
+            if len(role_cache) >= ROLE_CACHE_SIZE:
+                role_cache.clear()
+            role_cache[key] = (role, time.monotonic() + ROLE_CACHE_TTL)
+        roles[key] = role
+    return roles[key]
+
+def invalidate_role(user_id=None, project_id=None):
+    for key in list(role_cache):
+        if user_id in (None, key[0]) and project_id in (None, key[1]):
+            role_cache.pop(key, None)
+    g.pop('roles', None)
 
 def login_required(view):
     @functools.wraps(view)
     def wrapped_view(*args, **kwargs):
-        if g.user is None:
+        if g.user_id is None or g.user is None:
             return redirect(url_for('auth.login'))
         return view(*args, **kwargs)
     return wrapped_view
@@ -13,19 +62,19 @@ def login_required(view):
 def project_selected_required(view):
     @functools.wraps(view)
     def wrapped_view(*args, **kwargs):
+        if g.user_id is None:
+            return redirect(url_for('auth.login'))
         if g.project is None and 'project_id' not in request.view_args:
             return redirect(url_for('project.select', next=url_for(request.endpoint, **kwargs)))
         if g.project is None:
             g.project = db.get_or_404(Project, request.view_args['project_id'])
         return view(*args, **kwargs)
-    return login_required(wrapped_view)
+    return wrapped_view
 
 def perm_to_view_required(view):
     @functools.wraps(view)
     def wrapped_view(*args, **kwargs):
-        role = db.session.execute(
-            db.select(ProjectMember.role).filter_by(user_id=g.user.id, project_id=g.project.id)
-        ).scalar()
+        role = get_role(g.user_id, g.project.id)
         if role not in ('manager', 'editor', 'viewer'):
             flash('You do not have permission to view this project.')
             return redirect(request.referrer or url_for('index'))
@@ -35,9 +84,7 @@ def perm_to_view_required(view):
 def perm_to_edit_required(view):
     @functools.wraps(view)
     def wrapped_view(*args, **kwargs):
-        role = db.session.execute(
-            db.select(ProjectMember.role).filter_by(user_id=g.user.id, project_id=g.project.id)
-        ).scalar()
+        role = get_role(g.user_id, g.project.id)
         if role not in ('manager', 'editor'):
             flash('You do not have permission to edit this project.')
             return redirect(request.referrer or url_for('index'))
@@ -47,11 +94,32 @@ def perm_to_edit_required(view):
 def perm_to_manage_required(view):
     @functools.wraps(view)
     def wrapped_view(*args, **kwargs):
-        role = db.session.execute(
-            db.select(ProjectMember.role).filter_by(user_id=g.user.id, project_id=g.project.id)
-        ).scalar()
+        role = get_role(g.user_id, g.project.id)
         if role != 'manager':
             flash('You do not have permission to manage this project.')
             return redirect(request.referrer or url_for('index'))
         return view(*args, **kwargs)
     return project_selected_required(wrapped_view)
+
+def conditional(validator):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            version = change_version(db.select(db.func.max(User.updated_at)).filter_by(id=g.user_id), *validator(**kwargs))
+            last_modified = max((value for value in version if isinstance(value, datetime)), default=None)
+            settled = last_modified is None or last_modified < datetime.now() - VERSION_SETTLE_TIME
+            etag = hashlib.sha1(repr((request.full_path, g.project.id, version)).encode()).hexdigest()
+            if settled and etag in request.if_none_match:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            if settled:
+                response.set_etag(etag)
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapped_view
+    return decorator
@@ -0,0 +1,79 @@
+import click
+from flask.cli import with_appcontext
+from routes import bugtracking, requirement, testcase, testrun, testsuite
+from datetime import datetime
+from db import db, keyset_statement, PAGE_SIZE, Project, ProjectMember, ProjectStats, Requirement, RequirementTestCase, TestCase, TestSuite, TestSuiteCase, TestRun, TestResult, Bug, BugTestCase, Job
+
+def sample_ids():
+    first = lambda column: db.session.execute(db.select(column).limit(1)).scalar() or 0
+    return {
+        'user_id': first(ProjectMember.user_id),
+        'project_id': first(Project.id),
+        'requirement_id': first(Requirement.id),
+        'testcase_id': first(TestCase.id),
+        'testsuite_id': first(TestSuite.id),
+        'testrun_id': first(TestRun.id),
+        'bug_id': first(Bug.id)
+    }
+
+def page_query(statement, keys):
+    values = [datetime.now() if isinstance(key.type, db.DateTime) else 0 for key, _ in keys]
+    return keyset_statement(statement, keys, values, PAGE_SIZE + 1)
+
+def route_queries(ids):
+    return [
+        ('project.index', db.select(Project).join(ProjectMember).filter(ProjectMember.user_id == ids['user_id'])),
+        ('project.detail', db.select(Project, ProjectStats, TestRun).outerjoin(ProjectStats, ProjectStats.project_id == Project.id).outerjoin(TestRun, TestRun.id == ProjectStats.last_run_id).filter(Project.id == ids['project_id'])),
+        ('decorators.get_role', db.select(ProjectMember.role).filter_by(user_id=ids['user_id'], project_id=ids['project_id'])),
+        ('member.index', db.select(ProjectMember).filter_by(project_id=ids['project_id'])),
+        ('requirement.index', page_query(requirement.index_statement(ids['project_id']), requirement.PAGE_KEYS)),
+        ('requirement.detail', db.select(TestCase).join(RequirementTestCase).filter(RequirementTestCase.requirement_id == ids['requirement_id']).order_by(TestCase.order.asc())),
+        ('requirement.delete', db.update(Requirement).filter_by(project_id=ids['project_id']).where(Requirement.order > 1).values(order=Requirement.order - 1)),
+        ('testcase.index', page_query(testcase.index_statement(ids['project_id']), testcase.PAGE_KEYS)),
+        ('testcase.index requirements', db.select(Requirement).join(RequirementTestCase).filter(RequirementTestCase.test_case_id.in_([ids['testcase_id']]))),
+        ('testcase.delete', db.select(TestSuiteCase.test_suite_id, TestSuiteCase.order).filter_by(test_case_id=ids['testcase_id'])),
+        ('testsuite.index', page_query(testsuite.index_statement(ids['project_id']), testsuite.PAGE_KEYS)),
+        ('testsuite.detail', db.select(TestSuiteCase).filter_by(test_suite_id=ids['testsuite_id']).order_by(TestSuiteCase.order.asc())),
+        ('testrun.previous', page_query(testrun.previous_statement(ids['testsuite_id']), testrun.PAGE_KEYS)),
+        ('testrun.run_case', db.select(TestResult).filter_by(test_run_id=ids['testrun_id'], executed_at=None).order_by(TestResult.position.asc(), TestResult.id.asc()).limit(1)),
+        ('testrun.summary', db.select(TestResult).filter_by(test_run_id=ids['testrun_id'])),
+        ('bugtracking.index', page_query(bugtracking.index_statement(ids['project_id']), bugtracking.PAGE_KEYS)),
+        ('bugtracking.index counts', db.select(Bug.status, Bug.priority, db.func.count()).filter_by(project_id=ids['project_id']).group_by(Bug.status, Bug.priority)),
+        ('bugtracking.index test cases', db.select(TestCase).join(BugTestCase).filter(BugTestCase.bug_id.in_([ids['bug_id']]))),
+        ('bugtracking.detail', db.select(TestCase).join(BugTestCase).filter(BugTestCase.bug_id == ids['bug_id'])),
+        ('testcase.detail bugs', db.select(Bug).join(BugTestCase).filter(BugTestCase.test_case_id == ids['testcase_id'])),
+        ('job.index', db.select(Job).filter_by(user_id=ids['user_id']).order_by(Job.created_at.desc()).limit(50)),
+        ('job.claim', db.select(Job.id).filter_by(status='queued').order_by(Job.id.asc()).limit(1))
+    ]
+
+def explain(statement):
+    dialect = db.engine.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    result = db.session.execute(db.text(prefix + sql))
+    return list(result.keys()), [tuple(row) for row in result]
+
+def is_full_scan(columns, row):
+    plan = dict(zip(columns, row))
+    if 'type' in plan:
+        return plan['type'] == 'ALL'
+    detail = str(plan.get('detail', ''))
+    return detail.startswith('SCAN') and 'INDEX' not in detail
+
+@click.command('explain')
+@click.option('--only-scans', is_flag=True, help='Print only the queries that read a whole table.')
+@with_appcontext
+def explain_command(only_scans):
+    full_scans = 0
+    for name, statement in route_queries(sample_ids()):
+        columns, rows = explain(statement)
+        scans = [row for row in rows if is_full_scan(columns, row)]
+        full_scans += bool(scans)
+        if only_scans and not scans:
+            continue
+        click.echo(f"== {name}{' (FULL SCAN)' if scans else ''}")
+        click.echo('   ' + ' | '.join(columns))
+        for row in rows:
+            click.echo('   ' + ' | '.join('' if value is None else str(value) for value in row))
+    db.session.rollback()
+    click.echo(f"{full_scans} queries with full table scans.")
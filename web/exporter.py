@@ -0,0 +1,65 @@
+from db import db, iter_keyset, Requirement, TestCase, Bug
+from utils import EXPORT_CHUNK_SIZE, iter_json_object
+
+def iter_requirements(project_id):
+    requirements = db.session.execute(
+        db.select(Requirement).filter_by(project_id=project_id).order_by(Requirement.order.asc())
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    ).scalars()
+    for req in requirements:
+        yield req.code_with_prefix, {
+            'title': req.title,
+            'description': req.description,
+            'type': req.type,
+            'priority': req.priority
+        }
+
+def iter_testcases(project_id):
+    testcases = iter_keyset(
+        db.select(TestCase).filter_by(project_id=project_id).options(db.selectinload(TestCase.requirements)),
+        [(TestCase.order, False), (TestCase.id, False)]
+    )
+    for tc in testcases:
+        yield tc.code_with_prefix, {
+            'title': tc.title,
+            'requirements': ', '.join(tc.requirements_codes),
+            'preconditions': tc.preconditions,
+            'steps': tc.steps,
+            'expected_result': tc.expected_result
+        }
+
+def iter_bugs(project_id):
+    bugs = iter_keyset(
+        db.select(Bug).filter_by(project_id=project_id).options(db.selectinload(Bug.test_cases)),
+        [(Bug.order, False), (Bug.id, False)]
+    )
+    for bug in bugs:
+        yield bug.code_with_prefix, {
+            'title': bug.title,
+            'description': bug.description,
+            'testcases': ', '.join(bug.testcases_codes),
+            'status': bug.status,
+            'priority': bug.priority
+        }
+
+def report_progress(pairs, progress):
+    count = 0
+    for count, pair in enumerate(pairs, 1):
+        yield pair
+        if count % EXPORT_CHUNK_SIZE == 0:
+            progress(EXPORT_CHUNK_SIZE)
+    progress(count % EXPORT_CHUNK_SIZE)
+
+def iter_project_json(project, indent=4, progress=None):
+    sections = [
+        ('requirements', iter_requirements(project.id)),
+        ('testcases', iter_testcases(project.id)),
+        ('bugs', iter_bugs(project.id))
+    ]
+    if progress:
+        sections = [(name, report_progress(pairs, progress)) for name, pairs in sections]
+    return iter_json_object([
+        ('name', project.name),
+        ('description', project.description),
+        *sections
+    ], indent)
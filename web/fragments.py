@@ -0,0 +1,64 @@
+import hashlib
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from utils import LRUCache
+
+FRAGMENT_CACHE_SIZE = 20000
+FRAGMENT_CACHE_TTL = 60
+
+class FragmentCache:
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE, shared=None, ttl=FRAGMENT_CACHE_TTL):
+        self.local = LRUCache(maxsize, ttl)
+        self.shared = shared
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                value = value.decode() if isinstance(value, bytes) else value
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, self.ttl)
+
+    def clear(self):
+        self.local.clear()
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        location = nodes.Const(f'{parser.name}:{lineno}')
+        return nodes.CallBlock(self.call_method('render_fragment', [location, nodes.List(parts)]), [], [], body).set_lineno(lineno)
+
+    def render_fragment(self, location, parts, caller):
+        key = 'fragment:' + hashlib.sha1(repr((location, parts)).encode()).hexdigest()
+        cache = self.environment.fragment_cache
+        value = cache.get(key)
+        if value is None:
+            value = str(caller())
+            cache.set(key, value)
+        return Markup(value)
+
+def init_fragment_cache(app):
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache = FragmentCache(
+        app.config.get('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE),
+        app.config.get('FRAGMENT_CACHE_BACKEND'),
+        app.config.get('FRAGMENT_CACHE_TTL', FRAGMENT_CACHE_TTL)
+    )
@@ -0,0 +1,31 @@
+import os
+import resource
+import time
+
+started = time.perf_counter()
+
+wsgi_app = 'wsgi:app'
+bind = '0.0.0.0:8000'
+workers = 4
+preload_app = True
+
+def rss_mib():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def when_ready(server):
+    app = server.app.wsgi()
+    server.log.info('Application created in %.0f ms, ready in %.0f ms, master RSS %.1f MiB',
+                    app.config['STARTUP_SECONDS'] * 1000, (time.perf_counter() - started) * 1000, rss_mib())
+
+def post_fork(server, worker):
+    from db import db
+    with server.app.wsgi().app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+def post_worker_init(worker):
+    worker.log.info('Worker %s booted, RSS %.1f MiB', worker.pid, rss_mib())
@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from itertools import islice
+import time
+from db import db, bug_rank, reserve_orders, refresh_stats, Project, ProjectMember, Requirement, RequirementTestCase, TestCase, Bug, BugTestCase
+from utils import iter_json_records
+
+IMPORT_BATCH_SIZE = 1000
+SECTIONS = ('requirements', 'testcases', 'bugs')
+REQUIREMENT_TYPES = ('functional', 'quality', 'constraint')
+PRIORITIES = ('high', 'medium', 'low')
+BUG_STATUSES = ('open', 'progress', 'closed')
+
+@contextmanager
+def stage(timings, name):
+    started = time.perf_counter()
+    yield
+    timings[name] = timings.get(name, 0) + time.perf_counter() - started
+
+def timed(iterable, timings, name):
+    iterator = iter(iterable)
+    while True:
+        with stage(timings, name):
+            item = next(iterator, None)
+        if item is None:
+            return
+        yield item
+
+def split_codes(codes):
+    return [code for code in (codes or '').split(', ') if code]
+
+def validate_record(section, code, record):
+    if not isinstance(record, dict) or not record.get('title'):
+        raise ValueError(f'{code} has no title.')
+    if section == 'requirements':
+        if record.get('type') not in REQUIREMENT_TYPES:
+            raise ValueError(f'Requirement {code} has an invalid type.')
+        if record.get('priority', 'high') not in PRIORITIES:
+            raise ValueError(f'Requirement {code} has an invalid priority.')
+    elif section == 'bugs':
+        if record.get('status') not in BUG_STATUSES:
+            raise ValueError(f'Bug {code} has an invalid status.')
+        if record.get('priority') not in PRIORITIES:
+            raise ValueError(f'Bug {code} has an invalid priority.')
+
+def requirement_row(project_id, order, req):
+    return {
+        'project_id': project_id,
+        'title': req.get('title'),
+        'description': req.get('description', ''),
+        'type': req.get('type'),
+        'priority': req.get('priority', 'high'),
+        'order': order
+    }
+
+def testcase_row(project_id, order, tc):
+    return {
+        'project_id': project_id,
+        'title': tc.get('title'),
+        'preconditions': tc.get('preconditions', ''),
+        'steps': tc.get('steps', ''),
+        'expected_result': tc.get('expected_result', ''),
+        'order': order
+    }
+
+def bug_row(project_id, order, bug):
+    return {
+        'project_id': project_id,
+        'title': bug.get('title'),
+        'description': bug.get('description'),
+        'status': bug.get('status'),
+        'priority': bug.get('priority'),
+        'board_rank': bug_rank(bug.get('status'), bug.get('priority')),
+        'order': order
+    }
+
+SECTION_ROWS = {
+    'requirements': (Requirement, requirement_row),
+    'testcases': (TestCase, testcase_row),
+    'bugs': (Bug, bug_row)
+}
+
+def insert_batches(model, rows):
+    rows = iter(rows)
+    while batch := list(islice(rows, IMPORT_BATCH_SIZE)):
+        db.session.execute(db.insert(model), batch)
+
+def insert_section(model, project_id, rows):
+    if rows:
+        reserve_orders(model, project_id, len(rows))
+        insert_batches(model, rows)
+
+def lookup_ids(model, project_id):
+    return dict(db.session.execute(db.select(model.order, model.id).filter_by(project_id=project_id)).all())
+
+def create_project(header, manager_id):
+    if not header.get('name'):
+        raise ValueError('The project name must come before its requirements, test cases and bugs.')
+    project = Project(name=header['name'], description=header.get('description', ''), manager_id=manager_id)
+    db.session.add(project)
+    db.session.flush()
+    db.session.add(ProjectMember(project_id=project.id, user_id=manager_id, role="manager"))
+    return project
+
+def import_data(stream, manager_id, progress=None):
+    timings = {}
+    header = {}
+    project = None
+    batches = {section: [] for section in SECTIONS}
+    counts = dict.fromkeys(SECTIONS, 0)
+    req_orders = {}
+    tc_orders = {}
+    req_links = []
+    bug_links = []
+    for section, code, record in timed(iter_json_records(stream, SECTIONS), timings, 'parse'):
+        if code is None:
+            header[section] = record
+            continue
+        if project is None:
+            with stage(timings, 'project'):
+                project = create_project(header, manager_id)
+        with stage(timings, 'validate'):
+            validate_record(section, code, record)
+        counts[section] += 1
+        order = counts[section]
+        if section == 'requirements':
+            req_orders[code] = order
+        elif section == 'testcases':
+            tc_orders[code] = order
+            req_links.extend((order, req_code) for req_code in dict.fromkeys(split_codes(record.get('requirements'))))
+        else:
+            bug_links.extend((order, tc_code) for tc_code in dict.fromkeys(split_codes(record.get('testcases'))))
+        model, row = SECTION_ROWS[section]
+        batches[section].append(row(project.id, order, record))
+        if len(batches[section]) >= IMPORT_BATCH_SIZE:
+            with stage(timings, section):
+                insert_section(model, project.id, batches[section])
+            batches[section] = []
+            if progress:
+                progress()
+    if project is None:
+        with stage(timings, 'project'):
+            project = create_project(header, manager_id)
+    for section, rows in batches.items():
+        with stage(timings, section):
+            insert_section(SECTION_ROWS[section][0], project.id, rows)
+    with stage(timings, 'lookup'):
+        req_ids = lookup_ids(Requirement, project.id)
+        tc_ids = lookup_ids(TestCase, project.id)
+        bug_ids = lookup_ids(Bug, project.id)
+    with stage(timings, 'links'):
+        insert_batches(RequirementTestCase, (
+            {'requirement_id': req_ids[req_orders[req_code]], 'test_case_id': tc_ids[order]}
+            for order, req_code in req_links if req_code in req_orders
+        ))
+        insert_batches(BugTestCase, (
+            {'bug_id': bug_ids[order], 'test_case_id': tc_ids[tc_orders[tc_code]]}
+            for order, tc_code in bug_links if tc_code in tc_orders
+        ))
+    with stage(timings, 'stats'):
+        refresh_stats(project.id)
+    return project, timings
@@ -0,0 +1,163 @@
+from datetime import datetime, timedelta
+import os
+import time
+import uuid
+from flask import current_app
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.attributes import set_committed_value
+from db import db, Job, Project, Requirement, RequirementTestCase, TestCase, TestSuite, TestSuiteCase, TestRun, TestResult, Bug, BugTestCase
+from exporter import iter_project_json
+from importer import import_data
+from utils import iter_encoded
+
+JOB_STALE_SECONDS = 900
+JOB_MAX_ATTEMPTS = 3
+
+def jobs_folder():
+    folder = current_app.config.get('JOBS_FOLDER') or os.path.join(current_app.instance_path, 'jobs')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def active_job(kind, project_id):
+    return db.session.execute(
+        db.select(Job).filter(Job.kind == kind, Job.project_id == project_id, Job.status.in_(('queued', 'running'))).order_by(Job.id.asc()).limit(1)
+    ).scalar()
+
+def enqueue(kind, user_id, project_id=None, **payload):
+    job = Job(kind=kind, user_id=user_id, project_id=project_id, payload=payload)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def save_upload(file):
+    path = os.path.join(jobs_folder(), f"import-{uuid.uuid4().hex}.json")
+    file.save(path)
+    return path
+
+def set_progress(job, progress):
+    progress = max(0, min(int(progress), 99))
+    if progress == job.progress:
+        return
+    set_committed_value(job, 'progress', progress)
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Job).where(Job.id == job.id).values(progress=progress, heartbeat_at=datetime.now()))
+    except OperationalError:
+        current_app.logger.warning('Could not report progress of job %s', job.id)
+
+def run_import(job):
+    path = job.payload['path']
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size or 1
+        try:
+            project, timings = import_data(file, job.user_id, progress=lambda: set_progress(job, file.tell() * 100 / size))
+        except IntegrityError:
+            raise ValueError('Project with this name already exists.')
+    details = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in timings.items())
+    current_app.logger.info('Imported project %s (%s)', project.name, details)
+    job.project_id = project.id
+    job.message = f"Project imported in {sum(timings.values()):.2f}s ({details})."
+
+def run_export(job):
+    project = db.session.get(Project, job.project_id)
+    if project is None:
+        raise ValueError('The project no longer exists.')
+    compress = job.payload.get('compress', False)
+    total = sum(
+        db.session.execute(db.select(db.func.count()).select_from(model).filter_by(project_id=project.id)).scalar()
+        for model in (Requirement, TestCase, Bug)
+    ) or 1
+    done = 0
+    def progress(count):
+        nonlocal done
+        done += count
+        set_progress(job, done * 100 / total)
+    filename = f"{project.name.casefold()}_{datetime.now().date()}.json" + ('.gz' if compress else '')
+    path = os.path.join(jobs_folder(), f"export-{job.id}-{uuid.uuid4().hex}.json" + ('.gz' if compress else ''))
+    with open(path, 'wb') as file:
+        for chunk in iter_encoded(iter_project_json(project, job.payload.get('indent', 4), progress), compress):
+            file.write(chunk)
+    job.result_path = path
+    job.payload = {**job.payload, 'filename': filename}
+
+def run_delete(job):
+    project_id = job.project_id
+    suites = db.select(TestSuite.id).filter_by(project_id=project_id)
+    runs = db.select(TestRun.id).filter(TestRun.test_suite_id.in_(suites))
+    testcases = db.select(TestCase.id).filter_by(project_id=project_id)
+    steps = [
+        db.delete(TestResult).filter(TestResult.test_run_id.in_(runs)),
+        db.delete(TestRun).filter(TestRun.test_suite_id.in_(suites)),
+        db.delete(TestSuiteCase).filter(TestSuiteCase.test_suite_id.in_(suites)),
+        db.delete(TestSuite).filter_by(project_id=project_id),
+        db.delete(BugTestCase).filter(BugTestCase.test_case_id.in_(testcases)),
+        db.delete(RequirementTestCase).filter(RequirementTestCase.test_case_id.in_(testcases)),
+        db.delete(Bug).filter_by(project_id=project_id),
+        db.delete(TestCase).filter_by(project_id=project_id),
+        db.delete(Requirement).filter_by(project_id=project_id)
+    ]
+    for index, statement in enumerate(steps):
+        db.session.execute(statement.execution_options(synchronize_session=False))
+        set_progress(job, index * 100 / len(steps))
+    project = db.session.get(Project, project_id)
+    if project is not None:
+        db.session.delete(project)
+    job.message = 'Project deleted.'
+
+HANDLERS = {
+    'import': run_import,
+    'export': run_export,
+    'delete': run_delete
+}
+
+def recover_stale_jobs():
+    stale = db.and_(Job.status == 'running', Job.heartbeat_at < datetime.now() - timedelta(seconds=JOB_STALE_SECONDS))
+    failed = db.session.execute(
+        db.update(Job).where(stale, Job.attempts >= JOB_MAX_ATTEMPTS)
+        .values(status='failed', message='The worker stopped responding.', finished_at=datetime.now())
+    ).rowcount
+    requeued = db.session.execute(db.update(Job).where(stale).values(status='queued', started_at=None, heartbeat_at=None)).rowcount
+    db.session.commit()
+    if failed or requeued:
+        current_app.logger.warning('Recovered stale jobs: %s requeued, %s failed', requeued, failed)
+
+def claim_job():
+    recover_stale_jobs()
+    job_id = db.session.execute(db.select(Job.id).filter_by(status='queued').order_by(Job.id.asc()).limit(1)).scalar()
+    if job_id is None:
+        return None
+    claimed = db.session.execute(
+        db.update(Job).where(Job.id == job_id, Job.status == 'queued').values(status='running', started_at=datetime.now(), heartbeat_at=datetime.now(), attempts=Job.attempts + 1)
+    ).rowcount
+    db.session.commit()
+    return db.session.get(Job, job_id) if claimed else None
+
+def run_job(job):
+    started = time.perf_counter()
+    try:
+        HANDLERS[job.kind](job)
+        job.status = 'finished'
+        job.progress = 100
+        job.finished_at = datetime.now()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        if not isinstance(e, ValueError):
+            current_app.logger.exception('Job %s failed', job.id)
+        job.status = 'failed'
+        job.message = str(e)[:500]
+        job.finished_at = datetime.now()
+        db.session.commit()
+    if job.kind == 'import' and os.path.exists(job.payload['path']):
+        os.remove(job.payload['path'])
+    current_app.logger.info('Job %s (%s) %s in %.2fs', job.id, job.kind, job.status, time.perf_counter() - started)
+
+def work(interval=2.0, once=False):
+    while True:
+        job = claim_job()
+        if job is not None:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(interval)
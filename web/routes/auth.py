@@ -1,4 +1,4 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash, session, g, current_app
+from flask import Blueprint, request, render_template, redirect, url_for, flash, session, current_app
 from werkzeug.security import check_password_hash, generate_password_hash
 from sqlalchemy.exc import IntegrityError
 from utils import send_email, generate_reset_token, verify_reset_token
@@ -63,11 +63,3 @@ def reset_password_confirm(token):
         flash('Password has been reset. Please log in.')
         return redirect(url_for('auth.login'))
     return render_template('auth/reset_password_confirm.html', form=form)
-
-@bp.before_app_request
-def load_logged_in_user():
-    user_id = session.get('user_id')
-    if user_id is None:
-        g.user = None
-    else:
-        g.user = db.session.get(User, user_id)
@@ -1,28 +1,47 @@
+from collections import Counter
+import click
 from flask import Blueprint, render_template, request, redirect, url_for, g
-from db import db, Bug, TestCase, BugTestCase
-from decorators import perm_to_view_required, perm_to_edit_required
+from db import db, paginate, reserve_orders, release_order, update_stats, open_bug_delta, bug_rank, bug_rank_expression, project_versions, table_version, BUG_PRIORITY_RANK, User, Bug, TestCase, BugTestCase
+from decorators import perm_to_view_required, perm_to_edit_required, conditional
 from forms import BugForm
 
 bp = Blueprint('bugtracking', __name__, url_prefix='/bugtracking')
 
+PAGE_KEYS = [(Bug.board_rank, True), (Bug.created_at, True), (Bug.id, True)]
+
+def index_statement(project_id):
+    return (
+        db.select(Bug).filter_by(project_id=project_id).outerjoin(Bug.reporter_user)
+        .options(db.contains_eager(Bug.reporter_user), db.selectinload(Bug.test_cases))
+    )
+
 @bp.route('/')
 @perm_to_view_required
+@conditional(lambda: project_versions(g.project.id, Bug, BugTestCase, TestCase, User))
 def index():
-    bugs = db.session.execute(db.select(Bug).filter_by(project_id=g.project.id).order_by(Bug.created_at.desc())).scalars().all()
-    priority = {'high': 0, 'medium': 1, 'low': 2}
-    status = {'open': 0, 'progress': 0, 'closed': 1}
-    bugs.sort(key=lambda b: ((status.get(b.status, 3)), priority.get(b.priority, 3)))
-    open_bugs = [bug for bug in bugs if bug.status != 'closed']
-    high_open_bugs = sum(1 for bug in open_bugs if bug.priority == 'high')
-    medium_open_bugs = sum(1 for bug in open_bugs if bug.priority == 'medium')
-    low_open_bugs = len(open_bugs) - high_open_bugs - medium_open_bugs
+    statement = index_statement(g.project.id)
+    if request.args.get('q'):
+        statement = statement.filter(Bug.title.contains(request.args['q'], autoescape=True))
+    if request.args.get('status'):
+        statement = statement.filter_by(status=request.args['status'])
+    if request.args.get('priority'):
+        statement = statement.filter_by(priority=request.args['priority'])
+    bugs, next_cursor = paginate(statement, PAGE_KEYS, request.args.get('cursor'))
+    counts = db.session.execute(
+        db.select(Bug.status, Bug.priority, db.func.count()).filter_by(project_id=g.project.id).group_by(Bug.status, Bug.priority)
+    ).all()
+    open_counts = {priority: 0 for priority in BUG_PRIORITY_RANK}
+    for status, priority, count in counts:
+        if status != 'closed':
+            open_counts[priority] += count
     data = {
-        'open_bugs': len(open_bugs),
-        'high_open_bugs': high_open_bugs,
-        'medium_open_bugs': medium_open_bugs,
-        'low_open_bugs': low_open_bugs
+        'total_bugs': sum(count for _, _, count in counts),
+        'open_bugs': sum(open_counts.values()),
+        'high_open_bugs': open_counts['high'],
+        'medium_open_bugs': open_counts['medium'],
+        'low_open_bugs': open_counts['low']
     }
-    return render_template('bugtracking/index.html', bugs=bugs, data=data)
+    return render_template('bugtracking/index.html', bugs=bugs, data=data, next_cursor=next_cursor)
 
 @bp.route('/create', methods=['GET', 'POST'])
 @perm_to_edit_required
@@ -35,21 +54,24 @@ def create():
             description=form.description.data,
             status=form.status.data,
             priority=form.priority.data,
+            board_rank=bug_rank(form.status.data, form.priority.data),
             reported_by=g.user.id,
             project_id=g.project.id
         )
-        bug.order = bug.last_order + 1
+        bug.order = reserve_orders(Bug, g.project.id)
         db.session.add(bug)
         db.session.flush()
         tcs_ids = request.form.getlist('testcases_ids')
         for tc_id in tcs_ids:
             db.session.add(BugTestCase(bug_id=bug.id, test_case_id=tc_id))
+        update_stats(g.project.id, **open_bug_delta(bug.status, bug.priority))
         db.session.commit()
         return redirect(url_for('bugtracking.detail', bug_id=bug.id))
     return render_template('bugtracking/create.html', form=form, testcases=testcases)
 
 @bp.route('/<int:bug_id>')
 @perm_to_view_required
+@conditional(lambda bug_id: [table_version(Bug, Bug.id == bug_id), *project_versions(g.project.id, BugTestCase, TestCase, User)])
 def detail(bug_id):
     bug = db.get_or_404(Bug, bug_id)
     testcases = db.session.execute(db.select(TestCase).join(BugTestCase).filter(BugTestCase.bug_id == bug_id)).scalars().all()
@@ -63,10 +85,12 @@ def edit(bug_id):
     associated_ids = db.session.execute(db.select(BugTestCase.test_case_id).filter(BugTestCase.bug_id == bug_id)).scalars().all()
     testcases = db.session.execute(db.select(TestCase).filter(TestCase.project_id == g.project.id)).scalars().all()
     if request.method == 'POST' and form.validate():
+        deltas = Counter(open_bug_delta(bug.status, bug.priority, -1))
         bug.title = form.title.data
         bug.description = form.description.data
         bug.status = form.status.data
         bug.priority = form.priority.data
+        bug.board_rank = bug_rank(bug.status, bug.priority)
         db.session.flush()
         tcs_ids = request.form.getlist('testcases_ids')
         for tc in testcases:
@@ -74,6 +98,8 @@ def edit(bug_id):
                 db.session.add(BugTestCase(bug_id=bug.id, test_case_id=tc.id))
             elif str(tc.id) not in tcs_ids and tc.id in associated_ids:
                 db.session.execute(db.delete(BugTestCase).filter_by(bug_id=bug.id, test_case_id=tc.id))
+        deltas.update(open_bug_delta(bug.status, bug.priority))
+        update_stats(bug.project_id, **deltas)
         db.session.commit()
         return redirect(url_for('bugtracking.detail', bug_id=bug.id))
     return render_template('bugtracking/edit.html', form=form, testcases=testcases, associated_ids=associated_ids)
@@ -83,5 +109,14 @@ def edit(bug_id):
 def delete(bug_id):
     bug = db.get_or_404(Bug, bug_id)
     db.session.delete(bug)
+    db.session.flush()
+    release_order(Bug, bug.project_id, bug.order)
+    update_stats(bug.project_id, **open_bug_delta(bug.status, bug.priority, -1))
     db.session.commit()
     return redirect(url_for('bugtracking.index'))
+
+@bp.cli.command('rebuild-ranks')
+def rebuild_ranks():
+    updated = db.session.execute(db.update(Bug).values(board_rank=bug_rank_expression()).execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    click.echo(f"Rebuilt board ranks for {updated} bugs.")
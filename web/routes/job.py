@@ -0,0 +1,57 @@
+import click
+from flask import Blueprint, render_template, g, abort, jsonify, url_for, send_file
+from decorators import login_required
+from db import db, Job
+from jobs import work as run_worker
+
+bp = Blueprint('job', __name__, url_prefix='/job')
+
+def get_job_or_404(job_id):
+    job = db.get_or_404(Job, job_id)
+    if job.user_id != g.user.id:
+        abort(404)
+    return job
+
+@bp.route('/')
+@login_required
+def index():
+    jobs = db.session.execute(db.select(Job).filter_by(user_id=g.user.id).order_by(Job.created_at.desc()).limit(50)).scalars().all()
+    return render_template('job/index.html', jobs=jobs)
+
+@bp.route('/<int:job_id>')
+@login_required
+def detail(job_id):
+    job = get_job_or_404(job_id)
+    return render_template('job/detail.html', job=job)
+
+@bp.route('/<int:job_id>/status')
+@login_required
+def status(job_id):
+    job = get_job_or_404(job_id)
+    return jsonify({
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'message': job.message,
+        'download_url': url_for('job.download', job_id=job.id) if job.result_path and job.status == 'finished' else None
+    })
+
+@bp.route('/<int:job_id>/download')
+@login_required
+def download(job_id):
+    job = get_job_or_404(job_id)
+    if job.status != 'finished' or not job.result_path:
+        abort(404)
+    return send_file(
+        job.result_path,
+        as_attachment=True,
+        download_name=job.payload.get('filename'),
+        mimetype='application/gzip' if job.result_path.endswith('.gz') else 'application/json'
+    )
+
+@bp.cli.command('work')
+@click.option('--interval', default=2.0, help='Seconds to wait between polls when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty.')
+def work(interval, once):
+    run_worker(interval, once)
@@ -1,13 +1,13 @@
 from flask import Blueprint, render_template, request, redirect, url_for, g, flash
 from db import db, ProjectMember, User
-from decorators import perm_to_view_required, perm_to_manage_required
+from decorators import perm_to_view_required, perm_to_manage_required, invalidate_role
 
 bp = Blueprint('member', __name__, url_prefix='/member')
 
 @bp.route("/")
 @perm_to_view_required
 def index():
-    members = db.session.execute(db.select(ProjectMember).filter_by(project_id=g.project.id)).scalars().all()
+    members = db.session.execute(db.select(ProjectMember).filter_by(project_id=g.project.id).options(db.joinedload(ProjectMember.member))).scalars().all()
     return render_template("member/index.html", members=members)
 
 @bp.route("/<int:member_id>")
@@ -32,6 +32,7 @@ def create():
         elif user_id:
             db.session.add(ProjectMember(project_id=g.project.id, user_id=user_id, role=role))
             db.session.commit()
+            invalidate_role(user_id, g.project.id)
             return redirect(url_for('member.index'))
         flash(error or "User with that email does not exist.")
     return render_template("member/create.html")
@@ -46,6 +47,7 @@ def edit(member_id):
     if request.method == "POST":
         member.role = request.form.get("role")
         db.session.commit()
+        invalidate_role(member.user_id, member.project_id)
         return redirect(url_for('member.detail', member_id=member_id))
     return render_template("member/edit.html", member=member)
 
@@ -58,6 +60,7 @@ def delete(member_id):
     else:
         db.session.delete(member)
         db.session.commit()
+        invalidate_role(member.user_id, member.project_id)
     return redirect(url_for('member.index'))
 
 @bp.route("/<int:member_id>/exit", methods=["POST"])
@@ -69,4 +72,5 @@ def exit_project(member_id):
         return redirect(url_for('member.index'))
     db.session.delete(member)
     db.session.commit()
+    invalidate_role(member.user_id, member.project_id)
     return redirect(url_for('project.index'))
@@ -1,17 +1,28 @@
 from datetime import date
-from flask import Blueprint, render_template, request, g, redirect, url_for, session, send_file, flash
+import click
+from flask import Blueprint, abort, render_template, request, g, redirect, url_for, session, flash, Response, stream_with_context
 from sqlalchemy.exc import IntegrityError
-from decorators import login_required, perm_to_view_required, perm_to_manage_required
-from db import db, Project, ProjectMember, Requirement, RequirementTestCase, TestCase, Bug, BugTestCase
-from utils import create_json, import_json
+from decorators import login_required, perm_to_view_required, perm_to_manage_required, invalidate_role, conditional
+from db import db, refresh_stats, project_versions, table_version, Project, ProjectMember, ProjectStats, Requirement, RequirementTestCase, TestCase, TestRun, Bug, BugTestCase, User
+from utils import iter_encoded
+from exporter import iter_project_json
+from jobs import active_job, enqueue, save_upload
 from forms import ProjectForm
 
 bp = Blueprint('project', __name__, url_prefix='/project')
 
+def project_overview():
+    return (
+        db.select(Project, ProjectStats, TestRun, User.name.label('manager'))
+        .outerjoin(ProjectStats, ProjectStats.project_id == Project.id)
+        .outerjoin(TestRun, TestRun.id == ProjectStats.last_run_id)
+        .outerjoin(User, User.id == Project.manager_id)
+    )
+
 @bp.route('/')
 @login_required
 def index():
-    projects = db.session.execute(db.select(Project).join(ProjectMember).filter(ProjectMember.user_id == g.user.id)).scalars().all()
+    projects = db.session.execute(project_overview().join(ProjectMember).filter(ProjectMember.user_id == g.user.id).order_by(Project.name.asc())).all()
     return render_template('project/index.html', projects=projects)
 
 @bp.route('/select', methods=['GET', 'POST'])
@@ -25,15 +36,12 @@ def select():
 
 @bp.route('/<int:project_id>')
 @perm_to_view_required
+@conditional(lambda project_id: [table_version(Project, Project.id == project_id), table_version(ProjectStats, ProjectStats.project_id == project_id), *project_versions(project_id, TestRun, User)])
 def detail(project_id):
-    project = db.get_or_404(Project, project_id)
-    total_reqs = db.session.execute(db.select(db.func.count()).select_from(Requirement).filter_by(project_id=project.id)).scalar()
-    total_tcs = db.session.execute(db.select(db.func.count()).select_from(TestCase).filter_by(project_id=project.id)).scalar()
-    data = {
-        "total_reqs": total_reqs,
-        "total_tcs": total_tcs
-    }
-    return render_template('project/detail.html', project=project, data=data)
+    overview = db.session.execute(project_overview().filter(Project.id == project_id)).one_or_none()
+    if overview is None:
+        abort(404)
+    return render_template('project/detail.html', project=overview.Project, stats=overview.ProjectStats, last_run=overview.TestRun, manager=overview.manager)
 
 @bp.route('/create', methods=['GET', 'POST'])
 @login_required
@@ -50,7 +58,9 @@ def create():
             db.session.flush()
             project_member = ProjectMember(project_id=project.id, user_id=g.user.id, role="manager")
             db.session.add(project_member)
+            db.session.add(ProjectStats(project_id=project.id))
             db.session.commit()
+            invalidate_role(g.user.id, project.id)
             return redirect(url_for('project.detail', project_id=project.id))
         except IntegrityError:
             db.session.rollback()
@@ -76,55 +86,34 @@ def edit(project_id):
 @perm_to_manage_required
 def delete(project_id):
     project = db.get_or_404(Project, project_id)
-    db.session.delete(project)
-    db.session.commit()
-    return redirect(url_for('project.index'))
+    job = active_job('delete', project.id)
+    if job is None:
+        job = enqueue('delete', g.user.id, project.id)
+    else:
+        flash('This project is already scheduled for deletion.')
+        if job.user_id != g.user.id:
+            return redirect(url_for('project.detail', project_id=project_id))
+    return redirect(url_for('job.detail', job_id=job.id))
 
-@bp.route('/<int:project_id>/export')
+@bp.route('/<int:project_id>/export', methods=['GET', 'POST'])
 @perm_to_view_required
+@conditional(lambda project_id: [table_version(Project, Project.id == project_id), *project_versions(project_id, Requirement, TestCase, Bug, RequirementTestCase, BugTestCase)])
 def export(project_id):
     project = db.get_or_404(Project, project_id)
-    requirements = db.session.execute(db.select(Requirement).filter_by(project_id=project_id).order_by(Requirement.order.asc())).scalars().all()
-    testcases = db.session.execute(db.select(TestCase).filter_by(project_id=project_id).order_by(TestCase.order.asc())).scalars().all()
-    bugs = db.session.execute(db.select(Bug).filter_by(project_id=project_id).order_by(Bug.order.asc())).scalars().all()
-    project_data = {
-        'name': project.name,
-        'description': project.description,
-        'requirements': {
-            req.code_with_prefix: {
-                'title': req.title,
-                'description': req.description,
-                'type': req.type,
-                'priority': req.priority
-            } for req in requirements
-        },
-        'testcases': {
-            tc.code_with_prefix: {
-                'title': tc.title,
-                'requirements': ', '.join(tc.requirements_codes),
-                'preconditions': tc.preconditions,
-                'steps': tc.steps,
-                'expected_result': tc.expected_result
-            } for tc in testcases
-        },
-        'bugs': {
-            bug.code_with_prefix:{
-                'title': bug.title,
-                'description': bug.description,
-                'testcases': ', '.join(bug.testcases_codes),
-                'status': bug.status,
-                'priority': bug.priority
-            } for bug in bugs
-        }
-    }
-    buffer = create_json(project_data)
+    compress = request.values.get('compress') == 'gzip'
+    indent = None if request.values.get('indent') == '0' else 4
+    if request.method == 'POST':
+        job = enqueue('export', g.user.id, project.id, compress=compress, indent=indent)
+        return redirect(url_for('job.detail', job_id=job.id))
     filename = f"{project.name.casefold()}_{date.today()}.json"
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/json'
+    if compress:
+        filename += '.gz'
+    response = Response(
+        stream_with_context(iter_encoded(iter_project_json(project, indent), compress)),
+        mimetype='application/gzip' if compress else 'application/json'
     )
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    return response
 
 @bp.route('/import', methods=['GET', 'POST'])
 @login_required
@@ -134,81 +123,14 @@ def import_project():
         if not file or not file.filename.endswith('.json'):
             flash('No file selected or incorrect file type.')
         else:
-            data = import_json(file)
-            try:
-                project = Project(
-                    name=data.get('name'),
-                    description=data.get('description', ''),
-                    manager_id=g.user.id
-                )
-                db.session.add(project)
-                db.session.flush()
-                project_member = ProjectMember(project_id=project.id, user_id=g.user.id, role="manager")
-                db.session.add(project_member)
-                reqs = {}
-                order = 1
-                for code, req_data in data.get('requirements', {}).items():
-                    req = Requirement(
-                        project_id=project.id,
-                        title=req_data.get('title'),
-                        description=req_data.get('description', ''),
-                        type=req_data.get('type'),
-                        priority=req_data.get('priority', 'high'),
-                        order=order
-                    )
-                    db.session.add(req)
-                    reqs[code] = req
-                    order += 1
-                db.session.flush()
-                tcs = {}
-                order = 1
-                for code, tc_data in data.get('testcases', {}).items():
-                    tc = TestCase(
-                        project_id=project.id,
-                        title=tc_data.get('title'),
-                        preconditions=tc_data.get('preconditions'),
-                        steps=tc_data.get('steps'),
-                        expected_result=tc_data.get('expected_result'),
-                        order=order
-                    )
-                    db.session.add(tc)
-                    tcs[code] = tc
-                    db.session.flush()
-                    for req_code in tc_data.get('requirements', '').split(', '):
-                        if req_code in reqs:
-                            rtc = RequirementTestCase(
-                                requirement_id=reqs[req_code].id,
-                                test_case_id=tc.id
-                            )
-                            db.session.add(rtc)
-                    order += 1
-                order = 1
-                for bug_data in data.get('bugs', {}).values():
-                    bug = Bug(
-                        project_id=project.id,
-                        title=bug_data.get('title'),
-                        description=bug_data.get('description'),
-                        status=bug_data.get('status'),
-                        priority=bug_data.get('priority'),
-                        order=order,
-                    )
-                    db.session.add(bug)
-                    db.session.flush()
-                    for tc_code in bug_data.get('testcases', '').split(', '):
-                        if tc_code in tcs:
-                            db.session.add(BugTestCase(bug_id=bug.id, test_case_id=tcs[tc_code].id))
-                    order += 1
-                db.session.commit()
-                return redirect(url_for('project.detail', project_id=project.id))
-            except IntegrityError:
-                db.session.rollback()
-                flash('Project with this name already exists.')
+            job = enqueue('import', g.user.id, path=save_upload(file), filename=file.filename)
+            return redirect(url_for('job.detail', job_id=job.id))
     return render_template('project/import.html')
 
-@bp.before_app_request
-def load_project():
-    project_id = session.get('project_id')
-    if project_id is None:
-        g.project = None
-    else:
-        g.project = db.session.get(Project, project_id)
+@bp.cli.command('rebuild-stats')
+def rebuild_stats():
+    project_ids = db.session.execute(db.select(Project.id)).scalars().all()
+    for project_id in project_ids:
+        refresh_stats(project_id)
+    db.session.commit()
+    click.echo(f"Rebuilt statistics for {len(project_ids)} projects.")
@@ -1,18 +1,38 @@
-from flask import Blueprint, render_template, request, redirect, url_for, g
-from db import db, Requirement, RequirementTestCase, TestCase
-from decorators import perm_to_view_required, perm_to_edit_required
+from datetime import date
+from flask import Blueprint, render_template, request, redirect, url_for, g, flash, Response, stream_with_context
+from db import db, paginate, reserve_orders, release_order, apply_order, update_stats, refresh_stats, project_versions, table_version, PAGE_SIZE, Requirement, RequirementTestCase, TestCase, TestRun
+from decorators import perm_to_view_required, perm_to_edit_required, conditional
 from forms import RequirementForm
+from traceability import project_matrix
+from utils import iter_csv, iter_encoded
+
+def traceability_version():
+    return project_versions(g.project.id, Requirement, TestCase, RequirementTestCase, TestRun)
 
 bp = Blueprint('requirement', __name__, url_prefix='/requirement')
 
+PAGE_KEYS = [(Requirement.order, False), (Requirement.id, False)]
+
+def index_statement(project_id):
+    return db.select(Requirement).filter_by(project_id=project_id)
+
 @bp.route('/')
 @perm_to_view_required
+@conditional(lambda: project_versions(g.project.id, Requirement))
 def index():
-    requirements = db.session.execute(db.select(Requirement).filter_by(project_id=g.project.id).order_by(Requirement.order.asc())).scalars().all()
-    return render_template('requirement/index.html', requirements=requirements)
+    statement = index_statement(g.project.id)
+    if request.args.get('q'):
+        statement = statement.filter(Requirement.title.contains(request.args['q'], autoescape=True))
+    if request.args.get('type'):
+        statement = statement.filter_by(type=request.args['type'])
+    if request.args.get('priority'):
+        statement = statement.filter_by(priority=request.args['priority'])
+    requirements, next_cursor = paginate(statement, PAGE_KEYS, request.args.get('cursor'))
+    return render_template('requirement/index.html', requirements=requirements, next_cursor=next_cursor)
 
 @bp.route('/<int:requirement_id>')
 @perm_to_view_required
+@conditional(lambda requirement_id: [table_version(Requirement, Requirement.id == requirement_id), *project_versions(g.project.id, TestCase, RequirementTestCase)])
 def detail(requirement_id):
     requirement = db.get_or_404(Requirement, requirement_id)
     testcases = db.session.execute(db.select(TestCase).join(RequirementTestCase).filter(RequirementTestCase.requirement_id == requirement_id).order_by(TestCase.order.asc())).scalars().all()
@@ -30,17 +50,20 @@ def create():
             priority=form.priority.data,
             project_id=g.project.id
         )
-        requirement.order = requirement.last_order + 1
+        requirement.order = reserve_orders(Requirement, g.project.id)
         db.session.add(requirement)
         db.session.flush()
         tcs_ids = request.form.getlist('testcases_ids')
         for tc_id in tcs_ids:
             db.session.add(RequirementTestCase(requirement_id=requirement.id, test_case_id=tc_id))
+        db.session.flush()
+        update_stats(g.project.id, total_requirements=1)
+        if tcs_ids:
+            refresh_stats(g.project.id, 'covered_requirements')
         db.session.commit()
         return redirect(url_for('requirement.detail', requirement_id=requirement.id))
-    titles = db.session.execute(db.select(Requirement.title).filter_by(project_id=g.project.id)).scalars().all()
     testcases = db.session.execute(db.select(TestCase).filter_by(project_id=g.project.id).order_by(TestCase.order.asc())).scalars().all()
-    return render_template('requirement/create.html', form=form, titles=titles, testcases=testcases)
+    return render_template('requirement/create.html', form=form, testcases=testcases)
 
 @bp.route('/<int:requirement_id>/edit', methods=['GET', 'POST'])
 @perm_to_edit_required
@@ -61,6 +84,9 @@ def edit(requirement_id):
                 db.session.add(RequirementTestCase(requirement_id=requirement.id, test_case_id=tc.id))
             elif str(tc.id) not in tcs_ids and tc.id in associated_ids:
                 db.session.execute(db.delete(RequirementTestCase).filter_by(requirement_id=requirement.id, test_case_id=tc.id))
+        db.session.flush()
+        if bool(tcs_ids) != bool(associated_ids):
+            refresh_stats(requirement.project_id, 'covered_requirements')
         db.session.commit()
         return redirect(url_for('requirement.detail', requirement_id=requirement_id))
     return render_template('requirement/edit.html', form=form, testcases=testcases, associated_ids=associated_ids)
@@ -70,24 +96,48 @@ def edit(requirement_id):
 def delete(requirement_id):
     requirement = db.get_or_404(Requirement, requirement_id)
     db.session.delete(requirement)
-    db.session.commit()
-    requirements = db.session.execute(db.select(Requirement).filter_by(project_id=g.project.id).order_by(Requirement.order.asc())).scalars().all()
-    for index, req in enumerate(requirements):
-        req.order = index + 1
+    db.session.flush()
+    release_order(Requirement, requirement.project_id, requirement.order)
+    update_stats(requirement.project_id, total_requirements=-1)
+    refresh_stats(requirement.project_id, 'covered_requirements')
     db.session.commit()
     return redirect(url_for('requirement.index'))
 
-@bp.route('/reorder', methods=['GET'])
+@bp.route('/reorder', methods=['GET', 'POST'])
 @perm_to_edit_required
 def reorder():
+    if request.method == 'POST':
+        if apply_order(Requirement, request.form.getlist('ids', type=int), project_id=g.project.id):
+            db.session.commit()
+            return redirect(url_for('requirement.index'))
+        flash('The requirements changed since the page was loaded. Please try again.')
     requirements = db.session.execute(db.select(Requirement).filter_by(project_id=g.project.id).order_by(Requirement.order.asc())).scalars().all()
     return render_template('requirement/reorder.html', requirements=requirements)
 
-@bp.route('/<int:requirement_id1>/<int:requirement_id2>', methods=['POST'])
-@perm_to_edit_required
-def change_order(requirement_id1, requirement_id2):
-    requirement1 = db.get_or_404(Requirement, requirement_id1)
-    requirement2 = db.get_or_404(Requirement, requirement_id2)
-    requirement1.order, requirement2.order = requirement2.order, requirement1.order
-    db.session.commit()
-    return redirect(url_for('requirement.reorder'))
+@bp.route('/traceability')
+@perm_to_view_required
+@conditional(traceability_version)
+def traceability():
+    matrix = project_matrix(g.project.id)
+    indexes = range(len(matrix.requirements))
+    if request.args.get('uncovered'):
+        indexes = [index for index in indexes if not matrix.links[index]]
+    start = request.args.get('cursor', 0, type=int)
+    rows = [matrix.row(index) for index in indexes[start:start + PAGE_SIZE]]
+    next_cursor = str(start + PAGE_SIZE) if start + PAGE_SIZE < len(indexes) else None
+    return render_template('requirement/traceability.html', rows=rows, summary=matrix.summary(), next_cursor=next_cursor)
+
+@bp.route('/traceability/export')
+@perm_to_view_required
+@conditional(traceability_version)
+def export_traceability():
+    matrix = project_matrix(g.project.id)
+    compress = request.args.get('compress') == 'gzip'
+    filename = f"traceability_{g.project.name.casefold()}_{date.today()}.csv"
+    if compress:
+        filename += '.gz'
+    return Response(
+        stream_with_context(iter_encoded(iter_csv(matrix.iter_rows()), compress)),
+        mimetype='application/gzip' if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
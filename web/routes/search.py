@@ -0,0 +1,55 @@
+from flask import Blueprint, render_template, request, g, jsonify
+from decorators import perm_to_view_required
+from db import db
+from search import SEARCH_MODELS, SUGGEST_FIELDS, search, suggest
+from utils import code_with_prefix
+
+bp = Blueprint('search', __name__, url_prefix='/search')
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_RESULTS = {
+    'requirement': ('Requirement', 'REQ', 'requirement.detail', 'requirement_id'),
+    'testcase': ('Test Case', 'TC', 'testcase.detail', 'testcase_id'),
+    'bug': ('Bug', 'BUG', 'bugtracking.detail', 'bug_id')
+}
+
+def load_results(hits):
+    ids = {}
+    for kind, id, _ in hits:
+        ids.setdefault(kind, []).append(id)
+    rows = {}
+    for kind, kind_ids in ids.items():
+        model = SEARCH_MODELS[kind][0]
+        for id, order, title in db.session.execute(db.select(model.id, model.order, model.title).filter(model.id.in_(kind_ids))):
+            rows[(kind, id)] = (order, title)
+    results = []
+    for kind, id, score in hits:
+        if (kind, id) not in rows:
+            continue
+        order, title = rows[(kind, id)]
+        label, prefix, endpoint, arg = SEARCH_RESULTS[kind]
+        results.append({'kind': label, 'code': code_with_prefix(prefix, order), 'title': title, 'endpoint': endpoint, 'args': {arg: id}, 'score': score})
+    return results
+
+@bp.route('/')
+@perm_to_view_required
+def index():
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('kind')
+    page = max(request.args.get('page', 1, type=int), 1)
+    hits = search(g.project.id, query, [kind] if kind in SEARCH_MODELS else None, (page - 1) * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE + 1)
+    has_next = len(hits) > SEARCH_PAGE_SIZE
+    results = load_results(hits[:SEARCH_PAGE_SIZE])
+    return render_template('search/index.html', query=query, kind=kind, page=page, has_next=has_next, results=results, kinds=SEARCH_RESULTS)
+
+@bp.route('/suggest')
+@perm_to_view_required
+def suggestions():
+    kind = request.args.get('kind')
+    field = request.args.get('field')
+    prefix = request.args.get('q', '')
+    if field not in SUGGEST_FIELDS.get(kind, ()) or not prefix.strip():
+        return jsonify([])
+    response = jsonify(suggest(g.project.id, kind, field, prefix))
+    response.headers['Cache-Control'] = 'private, max-age=30'
+    return response
@@ -1,10 +1,11 @@
 from datetime import date
 import re
-from flask import Blueprint, render_template, request, redirect, url_for, g, Response
-from decorators import perm_to_view_required, perm_to_edit_required
-from utils import create_csv
-from db import db, TestCase, Requirement, RequirementTestCase
+from flask import Blueprint, render_template, request, redirect, url_for, g, flash, Response, stream_with_context
+from decorators import perm_to_view_required, perm_to_edit_required, conditional
+from utils import iter_csv, iter_encoded
+from db import db, paginate, iter_keyset, reserve_orders, release_order, apply_order, update_stats, refresh_stats, project_versions, table_version, TestCase, TestSuiteCase, Requirement, RequirementTestCase
 from forms import TestCaseForm
+from routes.testrun import remove_results
 
 def normalize_steps(steps):
     rows = re.sub(r'^\s*\d+[\.\-\)]?\s*', '', steps, flags=re.MULTILINE)
@@ -17,16 +18,36 @@ def normalize_steps(steps):
         norm_steps.append(f"{i}. {row}")
     return "\n".join(norm_steps)
 
+def testcases_version():
+    return project_versions(g.project.id, TestCase, Requirement, RequirementTestCase)
+
+def code_order(code):
+    match = re.search(r'(\d+)\s*$', code)
+    return int(match.group(1)) if match else None
+
 bp = Blueprint('testcase', __name__, url_prefix='/testcase')
 
+PAGE_KEYS = [(TestCase.order, False), (TestCase.id, False)]
+
+def index_statement(project_id):
+    return db.select(TestCase).filter_by(project_id=project_id).options(db.selectinload(TestCase.requirements))
+
 @bp.route('/')
 @perm_to_view_required
+@conditional(testcases_version)
 def index():
-    testcases = db.session.execute(db.select(TestCase).filter_by(project_id=g.project.id).order_by(TestCase.order.asc())).scalars().all()
-    return render_template('testcase/index.html', testcases=testcases)
+    statement = index_statement(g.project.id)
+    if request.args.get('q'):
+        statement = statement.filter(TestCase.title.contains(request.args['q'], autoescape=True))
+    requirement_order = code_order(request.args.get('requirement', ''))
+    if requirement_order:
+        statement = statement.filter(TestCase.requirements.any(Requirement.order == requirement_order))
+    testcases, next_cursor = paginate(statement, PAGE_KEYS, request.args.get('cursor'))
+    return render_template('testcase/index.html', testcases=testcases, next_cursor=next_cursor)
 
 @bp.route('/<int:testcase_id>')
 @perm_to_view_required
+@conditional(lambda testcase_id: [table_version(TestCase, TestCase.id == testcase_id), *project_versions(g.project.id, Requirement, RequirementTestCase)])
 def detail(testcase_id):
     testcase = db.get_or_404(TestCase, testcase_id)
     requirements = db.session.execute(db.select(Requirement).join(RequirementTestCase).filter(RequirementTestCase.test_case_id == testcase_id).order_by(Requirement.order.asc())).scalars().all()
@@ -44,22 +65,20 @@ def create():
             expected_result=form.expected_result.data,
             project_id=g.project.id
         )
-        testcase.order = testcase.last_order + 1
+        testcase.order = reserve_orders(TestCase, g.project.id)
         db.session.add(testcase)
         db.session.flush()
         reqs_ids = request.form.getlist('requirements_ids')
         for req_id in reqs_ids:
             db.session.add(RequirementTestCase(requirement_id=req_id, test_case_id=testcase.id))
+        db.session.flush()
+        update_stats(g.project.id, total_testcases=1)
+        if reqs_ids:
+            refresh_stats(g.project.id, 'covered_requirements')
         db.session.commit()
         return redirect(url_for('testcase.detail', testcase_id=testcase.id))
-    tcs_data = db.session.execute(db.select(TestCase.title, TestCase.preconditions, TestCase.expected_result).filter_by(project_id=g.project.id)).all()
-    suggestions = {
-        'titles': {td[0] for td in tcs_data},
-        'preconditions': {td[1] for td in tcs_data},
-        'expected_results': {td[2] for td in tcs_data}
-    }
     requirements = db.session.execute(db.select(Requirement).filter_by(project_id=g.project.id).order_by(Requirement.order.asc())).scalars().all()
-    return render_template('testcase/create.html', form=form, requirements=requirements, suggestions=suggestions)
+    return render_template('testcase/create.html', form=form, requirements=requirements)
 
 @bp.route('/<int:testcase_id>/edit', methods=['GET', 'POST'])
 @perm_to_edit_required
@@ -75,11 +94,17 @@ def edit(testcase_id):
         testcase.expected_result = form.expected_result.data
         db.session.flush()
         reqs_ids = request.form.getlist('requirements_ids')
+        links_changed = False
         for req in requirements:
             if str(req.id) in reqs_ids and req.id not in associated_ids:
                 db.session.add(RequirementTestCase(requirement_id=req.id, test_case_id=testcase.id))
+                links_changed = True
             elif str(req.id) not in reqs_ids and req.id in associated_ids:
                 db.session.execute(db.delete(RequirementTestCase).filter_by(requirement_id=req.id, test_case_id=testcase.id))
+                links_changed = True
+        db.session.flush()
+        if links_changed:
+            refresh_stats(testcase.project_id, 'covered_requirements')
         db.session.commit()
         return redirect(url_for('testcase.detail', testcase_id=testcase.id))
     return render_template('testcase/edit.html', form=form, requirements=requirements, associated_ids=associated_ids)
@@ -88,41 +113,53 @@ def edit(testcase_id):
 @perm_to_edit_required
 def delete(testcase_id):
     testcase = db.get_or_404(TestCase, testcase_id)
+    suite_orders = db.session.execute(db.select(TestSuiteCase.test_suite_id, TestSuiteCase.order).filter_by(test_case_id=testcase_id)).all()
+    remove_results(testcase_id)
     db.session.delete(testcase)
     db.session.flush()
-    testcases = db.session.execute(db.select(TestCase).filter_by(project_id=g.project.id).order_by(TestCase.order.asc())).scalars().all()
-    for index, tc in enumerate(testcases):
-        tc.order = index + 1
+    release_order(TestCase, testcase.project_id, testcase.order)
+    if suite_orders:
+        removed_order = db.case(dict(suite_orders), value=TestSuiteCase.test_suite_id)
+        db.session.execute(
+            db.update(TestSuiteCase).where(TestSuiteCase.test_suite_id.in_([id for id, _ in suite_orders]), TestSuiteCase.order > removed_order)
+            .values(order=TestSuiteCase.order - 1).execution_options(synchronize_session=False)
+        )
+    update_stats(testcase.project_id, total_testcases=-1)
+    refresh_stats(testcase.project_id, 'covered_requirements')
     db.session.commit()
     return redirect(url_for('testcase.index'))
 
-@bp.route('/reorder', methods=['GET'])
+@bp.route('/reorder', methods=['GET', 'POST'])
 @perm_to_edit_required
 def reorder():
-    testcases = db.session.execute(db.select(TestCase).filter_by(project_id=g.project.id).order_by(TestCase.order.asc())).scalars().all()
+    if request.method == 'POST':
+        if apply_order(TestCase, request.form.getlist('ids', type=int), project_id=g.project.id):
+            db.session.commit()
+            return redirect(url_for('testcase.index'))
+        flash('The test cases changed since the page was loaded. Please try again.')
+    testcases = db.session.execute(db.select(TestCase).filter_by(project_id=g.project.id).order_by(TestCase.order.asc()).options(db.selectinload(TestCase.requirements))).scalars().all()
     return render_template('testcase/reorder.html', testcases=testcases)
 
-@bp.route('/<int:testcase_id1>/<int:testcase_id2>', methods=['POST'])
-@perm_to_edit_required
-def change_order(testcase_id1, testcase_id2):
-    testcase1 = db.get_or_404(TestCase, testcase_id1)
-    testcase2 = db.get_or_404(TestCase, testcase_id2)
-    testcase1.order, testcase2.order = testcase2.order, testcase1.order
-    db.session.commit()
-    return redirect(url_for('testcase.reorder'))
-
 @bp.route('/export', methods=['GET'])
 @perm_to_view_required
+@conditional(testcases_version)
 def export():
-    testcases = db.session.execute(db.select(TestCase).filter_by(project_id=g.project.id).order_by(TestCase.order.asc())).scalars().all()
-    data = [("ID", "Title", "Requirements", "Preconditions", "Steps", "Expected Result")]
-    for tc in testcases:
-        data.append((tc.code_with_prefix, tc.title, ', '.join(tc.requirements_codes), tc.preconditions, tc.steps, tc.expected_result))
-    csv_data = create_csv(data)
+    project_id = g.project.id
+    compress = request.args.get('compress') == 'gzip'
+    def rows():
+        yield ("ID", "Title", "Requirements", "Preconditions", "Steps", "Expected Result")
+        testcases = iter_keyset(
+            db.select(TestCase).filter_by(project_id=project_id).options(db.selectinload(TestCase.requirements)),
+            [(TestCase.order, False), (TestCase.id, False)]
+        )
+        for tc in testcases:
+            yield (tc.code_with_prefix, tc.title, ', '.join(tc.requirements_codes), tc.preconditions, tc.steps, tc.expected_result)
     filename = f"testcases_{g.project.name.casefold()}_{date.today()}.csv"
+    if compress:
+        filename += '.gz'
     response = Response(
-        csv_data,
-        mimetype='text/csv',
+        stream_with_context(iter_encoded(iter_csv(rows()), compress)),
+        mimetype='application/gzip' if compress else 'text/csv',
         headers={"Content-disposition": f"attachment; filename={filename}"}
     )
     return response
@@ -1,37 +1,152 @@
 from datetime import datetime
-from flask import Blueprint, request, render_template, redirect, url_for, g, flash, Response
-from decorators import perm_to_view_required, perm_to_edit_required
+import click
+from flask import Blueprint, request, render_template, redirect, url_for, g, flash, Response, stream_with_context
+from decorators import perm_to_view_required, perm_to_edit_required, conditional
 from forms import BugForm, TestResultForm
-from db import db, TestCase, TestSuite, TestSuiteCase, TestRun, TestResult, Bug, BugTestCase
-from utils import create_csv, format_datetime
+from db import db, paginate, reserve_orders, update_stats, refresh_stats, open_bug_delta, bug_rank, project_versions, table_version, User, TestCase, TestSuite, TestSuiteCase, TestRun, TestResult, Bug, BugTestCase
+from utils import EXPORT_CHUNK_SIZE, LRUCache, code_with_prefix, format_datetime, iter_csv, iter_encoded
+
+STATUS_COUNTERS = {
+    'pass': TestRun.total_passed,
+    'fail': TestRun.total_failed,
+    'skip': TestRun.total_skipped
+}
+
+SUMMARY_CACHE_SIZE = 64
+SUMMARY_CACHE_TTL = 300
+summary_cache = LRUCache(SUMMARY_CACHE_SIZE, SUMMARY_CACHE_TTL)
+NAVIGATION_CACHE_SIZE = 256
+navigation_cache = LRUCache(NAVIGATION_CACHE_SIZE)
+
+def update_counters(testrun_id, status, previous_status=None, duration=None):
+    counters = {TestRun.updated_at: datetime.now()}
+    if previous_status is None:
+        counters[TestRun.total_executed] = TestRun.total_executed + 1
+        counters[TestRun.duration] = TestRun.duration + (duration or 0)
+    elif previous_status != status:
+        counters[STATUS_COUNTERS[previous_status]] = STATUS_COUNTERS[previous_status] - 1
+    if previous_status != status:
+        counters[STATUS_COUNTERS[status]] = STATUS_COUNTERS[status] + 1
+    db.session.execute(db.update(TestRun).where(TestRun.id == testrun_id).values(counters))
+    if previous_status is None:
+        db.session.execute(db.update(TestRun).where(TestRun.id == testrun_id).values(is_finished=TestRun.total_executed >= TestRun.total_results))
+
+def remove_results(test_case_id):
+    executed = TestResult.executed_at != None
+    removed = db.session.execute(
+        db.select(
+            TestResult.test_run_id,
+            db.func.count().label('results'),
+            db.func.count(TestResult.executed_at).label('executed'),
+            *(db.func.sum(db.case((executed & (TestResult.status == status), 1), else_=0)).label(status) for status in STATUS_COUNTERS),
+            db.func.sum(db.case((executed, TestResult.duration), else_=0)).label('duration')
+        ).filter(TestResult.test_case_id == test_case_id).group_by(TestResult.test_run_id)
+    ).all()
+    if not removed:
+        return
+    testrun_ids = [row.test_run_id for row in removed]
+    delta = lambda name: db.case({row.test_run_id: getattr(row, name) or 0 for row in removed}, value=TestRun.id)
+    counters = {
+        TestRun.updated_at: datetime.now(),
+        TestRun.total_results: TestRun.total_results - delta('results'),
+        TestRun.total_executed: TestRun.total_executed - delta('executed'),
+        TestRun.duration: TestRun.duration - delta('duration'),
+        **{counter: counter - delta(status) for status, counter in STATUS_COUNTERS.items()}
+    }
+    db.session.execute(db.update(TestRun).where(TestRun.id.in_(testrun_ids)).values(counters).execution_options(synchronize_session=False))
+    db.session.execute(
+        db.update(TestRun).where(TestRun.id.in_(testrun_ids)).values(is_finished=TestRun.total_executed >= TestRun.total_results)
+        .execution_options(synchronize_session=False)
+    )
+    for testrun_id in testrun_ids:
+        navigation_cache.pop(testrun_id)
+
+def navigation_version(testrun):
+    return (testrun.total_executed, testrun.total_results)
+
+def run_navigation(testrun):
+    cached = navigation_cache.get(testrun.id)
+    if cached is not None and cached[0] == navigation_version(testrun):
+        return cached[1]
+    navigation = db.session.execute(
+        db.select(TestResult.id, TestResult.executed_at.is_not(None)).filter(TestResult.test_run_id == testrun.id).order_by(TestResult.position.asc(), TestResult.id.asc())
+    ).tuples().all()
+    navigation_cache.set(testrun.id, (navigation_version(testrun), navigation))
+    return navigation
+
+def mark_executed(testrun_id, version, testresult_id):
+    cached = navigation_cache.get(testrun_id)
+    if cached is not None and cached[0] == version:
+        navigation = [(id, executed or id == testresult_id) for id, executed in cached[1]]
+        navigation_cache.set(testrun_id, ((version[0] + 1, version[1]), navigation))
+
+def summary_rows(testrun):
+    key = (testrun.id, testrun.updated_at)
+    rows = summary_cache.get(key) if testrun.is_finished else None
+    if rows is None:
+        results = db.session.execute(
+            db.select(
+                TestResult.id, TestResult.test_case_id, TestResult.status, TestResult.executed_at, TestResult.duration, TestResult.notes,
+                TestCase.order.label('testcase_order'), TestCase.title.label('testcase_title'), User.name.label('executor')
+            )
+            .join(TestCase, TestResult.test_case_id == TestCase.id).outerjoin(User, TestResult.executed_by == User.id)
+            .filter(TestResult.test_run_id == testrun.id).order_by(TestResult.position.asc(), TestResult.id.asc())
+        ).all()
+        rows = [{**row._asdict(), 'testcase_code': code_with_prefix("TC", row.testcase_order)} for row in results]
+        if testrun.is_finished:
+            summary_cache.set(key, rows)
+    return rows
+
+def open_bugs_by_testcase(testrun_id):
+    open_bugs = {}
+    bugs = db.session.execute(
+        db.select(BugTestCase.test_case_id, Bug).join(Bug, BugTestCase.bug_id == Bug.id)
+        .filter(Bug.status != 'closed', BugTestCase.test_case_id.in_(db.select(TestResult.test_case_id).filter_by(test_run_id=testrun_id)))
+        .order_by(Bug.order.asc())
+    ).all()
+    for test_case_id, bug in bugs:
+        open_bugs.setdefault(test_case_id, []).append(bug)
+    return open_bugs
 
 bp = Blueprint('testrun', __name__, url_prefix='/testrun')
 
-@bp.route('/<int:testsuite_id>/create', methods=['GET'])
+PAGE_KEYS = [(TestRun.created_at, True), (TestRun.id, True)]
+
+def previous_statement(testsuite_id):
+    return db.select(TestRun).filter_by(test_suite_id=testsuite_id)
+
+@bp.route('/<int:testsuite_id>/create', methods=['POST'])
 @perm_to_edit_required
 def create(testsuite_id):
-    tscs = db.session.execute(db.select(TestSuiteCase).filter_by(test_suite_id=testsuite_id).order_by(TestSuiteCase.order.asc())).scalars().all()
-    if len(tscs) == 0:
-        flash('No test cases in the test suite. Please add test cases before creating a test run.')
-        return redirect(url_for('testsuite.detail', testsuite_id=testsuite_id))
-    testrun = TestRun(test_suite_id=testsuite_id)
+    testsuite = db.get_or_404(TestSuite, testsuite_id)
+    testrun = TestRun(test_suite_id=testsuite.id)
     db.session.add(testrun)
     db.session.flush()
-    for tsc in tscs:
-        testresult = TestResult(
-            test_run_id=testrun.id,
-            test_case_id=tsc.test_case_id
+    total_results = db.session.execute(
+        db.insert(TestResult).from_select(
+            ['test_run_id', 'test_case_id', 'position'],
+            db.select(db.literal(testrun.id), TestSuiteCase.test_case_id, TestSuiteCase.order).filter_by(test_suite_id=testsuite.id).order_by(TestSuiteCase.order.asc())
         )
-        db.session.add(testresult)
+    ).rowcount
+    if total_results == 0:
+        db.session.rollback()
+        flash('No test cases in the test suite. Please add test cases before creating a test run.')
+        return redirect(url_for('testsuite.detail', testsuite_id=testsuite_id))
+    testrun.total_results = total_results
+    refresh_stats(testsuite.project_id, 'last_run_id')
     db.session.commit()
     return redirect(url_for('testrun.run_case', testrun_id=testrun.id))
 
 @bp.route('/<int:testsuite_id>/previous', methods=['GET'])
 @perm_to_view_required
+@conditional(lambda testsuite_id: [table_version(TestSuite, TestSuite.id == testsuite_id), table_version(TestRun, TestRun.test_suite_id == testsuite_id)])
 def previous(testsuite_id):
-    testruns = db.session.execute(db.select(TestRun).filter_by(test_suite_id=testsuite_id).order_by(TestRun.created_at.desc())).scalars().all()
+    statement = previous_statement(testsuite_id)
+    if request.args.get('status') in ('finished', 'running'):
+        statement = statement.filter_by(is_finished=request.args['status'] == 'finished')
+    testruns, next_cursor = paginate(statement, PAGE_KEYS, request.args.get('cursor'))
     ts_name = db.session.execute(db.select(TestSuite.name).filter_by(id=testsuite_id)).scalar()
-    return render_template('testrun/previous.html', testruns=testruns, ts_name=ts_name)
+    return render_template('testrun/previous.html', testruns=testruns, ts_name=ts_name, next_cursor=next_cursor)
 
 @bp.route('/<int:testrun_id>/delete', methods=['POST'])
 @perm_to_edit_required
@@ -39,6 +154,8 @@ def delete(testrun_id):
     testrun = db.get_or_404(TestRun, testrun_id)
     testsuite_id = testrun.test_suite_id
     db.session.delete(testrun)
+    db.session.flush()
+    refresh_stats(g.project.id, 'last_run_id')
     db.session.commit()
     return redirect(url_for('testrun.previous', testsuite_id=testsuite_id))
 
@@ -46,34 +163,41 @@ def delete(testrun_id):
 @perm_to_edit_required
 def run_case(testrun_id):
     testrun = db.get_or_404(TestRun, testrun_id)
+    statement = db.select(TestResult).filter_by(test_run_id=testrun.id).options(db.joinedload(TestResult.test_case).selectinload(TestCase.bugs))
     if 'testresult_id' in request.args:
-        testresult = db.get_or_404(TestResult, request.args.get('testresult_id'))
+        testresult = db.first_or_404(statement.filter_by(id=request.args.get('testresult_id', type=int)))
     else:
-        testresult = db.session.execute(db.select(TestResult).filter_by(test_run_id=testrun.id, executed_at=None)).scalars().first()
+        testresult = db.session.execute(statement.filter_by(executed_at=None).order_by(TestResult.position.asc(), TestResult.id.asc()).limit(1)).scalar()
         if not testresult:
             return redirect(url_for('testrun.summary', testrun_id=testrun.id))
     form = TestResultForm(request.form, obj=testresult)
     if request.method == 'POST' and form.validate():
-        if testresult.executed_at is None:
-            testresult.executed_at = datetime.now()
-            testresult.executed_by = g.user.id
-            testresult.duration = int(request.form['duration'])
+        duration = int(request.form['duration']) if testresult.executed_at is None else None
+        first_submit = duration is not None and db.session.execute(
+            db.update(TestResult).where(TestResult.id == testresult.id, TestResult.executed_at == None)
+            .values(executed_at=datetime.now(), executed_by=g.user.id, duration=duration).execution_options(synchronize_session=False)
+        ).rowcount == 1
+        previous_status = None if first_submit else db.session.execute(db.select(TestResult.status).filter_by(id=testresult.id).with_for_update()).scalar()
         testresult.status = form.status.data
         testresult.notes = form.notes.data
+        version = navigation_version(testrun)
+        update_counters(testrun.id, testresult.status, previous_status, duration)
         db.session.commit()
+        if first_submit:
+            mark_executed(testrun.id, version, testresult.id)
         return redirect(url_for('testrun.run_case', testrun_id=testrun.id))
-    testcase = db.session.get(TestCase, testresult.test_case_id)
-    testresults = db.session.execute(db.select(TestResult).filter_by(test_run_id=testrun.id)).scalars().all()
-    return render_template('testrun/run_case.html', form=form, testrun=testrun, testcase=testcase, testresults=testresults)
+    return render_template('testrun/run_case.html', form=form, testrun=testrun, testcase=testresult.test_case, navigation=run_navigation(testrun))
 
 @bp.route('/<int:testrun_id>/summary', methods=['GET'])
 @perm_to_view_required
+@conditional(lambda testrun_id: [table_version(TestRun, TestRun.id == testrun_id), *project_versions(g.project.id, TestCase, Bug, BugTestCase, User)])
 def summary(testrun_id):
     testrun = db.get_or_404(TestRun, testrun_id)
-    testresults = db.session.execute(db.select(TestResult).filter_by(test_run_id=testrun.id)).scalars().all()
-    total_tests = len(testresults)
-    passed_tests = sum(1 for r in testresults if r.status == 'pass')
-    failed_tests = sum(1 for r in testresults if r.status == 'fail')
+    testresults = summary_rows(testrun)
+    open_bugs = open_bugs_by_testcase(testrun.id)
+    total_tests = testrun.total_results
+    passed_tests = testrun.total_passed
+    failed_tests = testrun.total_failed
     skipped_tests = total_tests - passed_tests - failed_tests
     percent_passed = round((passed_tests / total_tests * 100), 2) if total_tests > 0 else 0
     data = {
@@ -85,7 +209,7 @@ def summary(testrun_id):
         'total_duration_min': testrun.duration // 60,
         'percent_passed': percent_passed
     }
-    return render_template('testrun/summary.html', testrun=testrun, testresults=testresults, data=data)
+    return render_template('testrun/summary.html', testrun=testrun, testresults=testresults, open_bugs=open_bugs, data=data)
 
 @bp.route('/<int:testresult_id>/report_bug', methods=['GET', 'POST'])
 @perm_to_edit_required
@@ -98,13 +222,15 @@ def report_bug(testresult_id):
             description=form.description.data,
             status=form.status.data,
             priority=form.priority.data,
+            board_rank=bug_rank(form.status.data, form.priority.data),
             reported_by=g.user.id,
             project_id=g.project.id
         )
-        bug.order = bug.last_order + 1
+        bug.order = reserve_orders(Bug, g.project.id)
         db.session.add(bug)
         db.session.flush()
         db.session.add(BugTestCase(bug_id=bug.id, test_case_id=testresult.test_case_id))
+        update_stats(g.project.id, **open_bug_delta(bug.status, bug.priority))
         db.session.commit()
         return redirect(url_for('testrun.run_case', testrun_id=testresult.test_run_id))
     form.description.data = testresult.notes
@@ -112,29 +238,66 @@ def report_bug(testresult_id):
 
 @bp.route('/<int:testrun_id>/export', methods=['GET'])
 @perm_to_view_required
+@conditional(lambda testrun_id: [table_version(TestRun, TestRun.id == testrun_id), table_version(TestSuite).join(TestRun).filter(TestRun.id == testrun_id), *project_versions(g.project.id, TestCase, User)])
 def export(testrun_id):
     testrun = db.get_or_404(TestRun, testrun_id)
-    testresults = db.session.execute(
-        db.select(TestResult).filter_by(test_run_id=testrun.id)
-    ).scalars().all()
-    data = [("Test Case", "Status", "Executed By", "Executed At", "Duration", "Notes")]
-    for testresult in testresults:
-        data.append((
-            testresult.testcase_code,
-            testresult.status,
-            testresult.executor,
-            format_datetime(testresult.executed_at),
-            testresult.duration,
-            testresult.notes
-        ))
-    csv_data = create_csv(data)
+    compress = request.args.get('compress') == 'gzip'
+    def rows():
+        yield ("Test Case", "Status", "Executed By", "Executed At", "Duration", "Notes")
+        testresults = db.session.execute(
+            db.select(TestResult).filter_by(test_run_id=testrun_id).order_by(TestResult.position.asc(), TestResult.id.asc())
+            .options(db.joinedload(TestResult.test_case), db.joinedload(TestResult.executor_user))
+            .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        ).scalars()
+        for testresult in testresults:
+            yield (
+                testresult.testcase_code,
+                testresult.status,
+                testresult.executor,
+                format_datetime(testresult.executed_at),
+                testresult.duration,
+                testresult.notes
+            )
     name = db.session.execute(
         db.select(TestSuite.name).filter_by(id=testrun.test_suite_id)
     ).scalar()
     filename = f"testrun_{name.casefold()}.csv"
+    if compress:
+        filename += '.gz'
     response = Response(
-        csv_data,
-        mimetype="text/csv",
+        stream_with_context(iter_encoded(iter_csv(rows()), compress)),
+        mimetype='application/gzip' if compress else "text/csv",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
     return response
+
+@bp.cli.command('rebuild-counters')
+def rebuild_counters():
+    executed = TestResult.executed_at != None
+    counters = db.session.execute(
+        db.select(
+            TestResult.test_run_id,
+            db.func.count(),
+            db.func.count(TestResult.executed_at),
+            db.func.sum(db.case((executed & (TestResult.status == 'pass'), 1), else_=0)),
+            db.func.sum(db.case((executed & (TestResult.status == 'fail'), 1), else_=0)),
+            db.func.sum(db.case((executed & (TestResult.status == 'skip'), 1), else_=0)),
+            db.func.sum(db.case((executed, TestResult.duration), else_=0))
+        ).group_by(TestResult.test_run_id)
+    ).all()
+    db.session.execute(db.update(TestRun).values(total_results=0, total_executed=0, total_passed=0, total_failed=0, total_skipped=0, duration=0, is_finished=True))
+    if counters:
+        db.session.execute(db.update(TestRun), [
+            {
+                'id': testrun_id,
+                'total_results': total,
+                'total_executed': executed,
+                'total_passed': passed,
+                'total_failed': failed,
+                'total_skipped': skipped,
+                'duration': duration or 0,
+                'is_finished': executed >= total
+            } for testrun_id, total, executed, passed, failed, skipped, duration in counters
+        ])
+    db.session.commit()
+    click.echo(f"Rebuilt counters for {len(counters)} test runs.")
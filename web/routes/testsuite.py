@@ -1,21 +1,42 @@
-from flask import Blueprint, render_template, request, redirect, url_for, g
-from decorators import perm_to_view_required, perm_to_edit_required
-from db import db, TestSuite, TestCase, TestSuiteCase
+import json
+from flask import Blueprint, render_template, request, redirect, url_for, g, flash, Response, stream_with_context
+from decorators import perm_to_view_required, perm_to_edit_required, conditional
+from db import db, paginate, close_gaps, apply_order, refresh_stats, project_versions, table_version, PAGE_SIZE, TestSuite, TestCase, TestSuiteCase, TestRun
 from forms import TestSuiteForm
+from analytics import suite_history, metric_rows
+from utils import iter_csv, iter_encoded
+
+ANALYTICS_RECENT_RUNS = 20
+ANALYTICS_COLUMNS = (
+    'test_case_id', 'code', 'title', 'executions', 'passes', 'failures', 'pass_rate', 'flips', 'flip_rate',
+    'runs_since_failure', 'last_failure_at', 'duration_p50', 'duration_p90'
+)
+
+def analytics_version(testsuite_id):
+    return [table_version(TestSuite, TestSuite.id == testsuite_id), table_version(TestRun, TestRun.test_suite_id == testsuite_id), *project_versions(g.project.id, TestCase)]
 
 bp = Blueprint('testsuite', __name__, url_prefix='/testsuite')
 
+PAGE_KEYS = [(TestSuite.created_at, True), (TestSuite.id, True)]
+
+def index_statement(project_id):
+    return db.select(TestSuite).filter_by(project_id=project_id)
+
 @bp.route('/')
 @perm_to_view_required
+@conditional(lambda: project_versions(g.project.id, TestSuite))
 def index():
-    testsuites = db.session.execute(db.select(TestSuite).filter_by(project_id=g.project.id).order_by(TestSuite.created_at.desc())).scalars().all()
-    return render_template('testsuite/index.html', testsuites=testsuites)
+    statement = index_statement(g.project.id)
+    if request.args.get('q'):
+        statement = statement.filter(TestSuite.name.contains(request.args['q'], autoescape=True))
+    testsuites, next_cursor = paginate(statement, PAGE_KEYS, request.args.get('cursor'))
+    return render_template('testsuite/index.html', testsuites=testsuites, next_cursor=next_cursor)
 
 @bp.route('/<int:testsuite_id>')
 @perm_to_view_required
 def detail(testsuite_id):
     testsuite = db.get_or_404(TestSuite, testsuite_id)
-    tscs = db.session.execute(db.select(TestSuiteCase).filter_by(test_suite_id=testsuite_id).order_by(TestSuiteCase.order.asc())).scalars().all()
+    tscs = db.session.execute(db.select(TestSuiteCase).filter_by(test_suite_id=testsuite_id).order_by(TestSuiteCase.order.asc()).options(db.joinedload(TestSuiteCase.test_case))).scalars().all()
     return render_template('testsuite/detail.html', testsuite=testsuite, tscs=tscs)
 
 @bp.route('/create', methods=['GET', 'POST'])
@@ -51,12 +72,18 @@ def edit(testsuite_id):
         db.session.flush()
         tcs_ids = request.form.getlist('testcases_ids')
         last_order = db.session.execute(db.select(TestSuiteCase.order).filter_by(test_suite_id=testsuite_id).order_by(TestSuiteCase.order.desc()).limit(1)).scalars().first() or 0
+        removed_ids = [tc.id for tc in testcases if str(tc.id) not in tcs_ids and tc.id in associated_ids]
+        removed_orders = db.session.execute(
+            db.select(TestSuiteCase.order).filter(TestSuiteCase.test_suite_id == testsuite_id, TestSuiteCase.test_case_id.in_(removed_ids)).order_by(TestSuiteCase.order.desc())
+        ).scalars().all()
+        if removed_orders:
+            db.session.execute(db.delete(TestSuiteCase).filter(TestSuiteCase.test_suite_id == testsuite_id, TestSuiteCase.order.in_(removed_orders)))
+            close_gaps(TestSuiteCase, removed_orders, test_suite_id=testsuite_id)
+            last_order -= len(removed_orders)
         for tc in testcases:
             if str(tc.id) in tcs_ids and tc.id not in associated_ids:
                 db.session.add(TestSuiteCase(test_suite_id=testsuite_id, test_case_id=tc.id, order=last_order + 1))
                 last_order += 1
-            elif str(tc.id) not in tcs_ids and tc.id in associated_ids:
-                db.session.execute(db.delete(TestSuiteCase).where(TestSuiteCase.test_suite_id == testsuite_id, TestSuiteCase.test_case_id == tc.id))
         db.session.commit()
         return redirect(url_for('testsuite.detail', testsuite_id=testsuite.id))
     testcases = db.session.execute(db.select(TestCase).filter_by(project_id=g.project.id).order_by(TestCase.order.asc())).scalars().all()
@@ -67,14 +94,53 @@ def edit(testsuite_id):
 def delete(testsuite_id):
     testsuite = db.get_or_404(TestSuite, testsuite_id)
     db.session.delete(testsuite)
+    db.session.flush()
+    refresh_stats(testsuite.project_id, 'last_run_id')
     db.session.commit()
     return redirect(url_for('testsuite.index'))
 
-@bp.route('/<int:testsuitecase_id1>/<int:testsuitecase_id2>/change_order', methods=['POST'])
+@bp.route('/<int:testsuite_id>/reorder', methods=['GET', 'POST'])
 @perm_to_edit_required
-def change_order(testsuitecase_id1, testsuitecase_id2):
-    tsc1 = db.get_or_404(TestSuiteCase, testsuitecase_id1)
-    tsc2 = db.get_or_404(TestSuiteCase, testsuitecase_id2)
-    tsc1.order, tsc2.order = tsc2.order, tsc1.order
-    db.session.commit()
-    return redirect(url_for('testsuite.detail', testsuite_id=tsc1.test_suite_id))
+def reorder(testsuite_id):
+    testsuite = db.get_or_404(TestSuite, testsuite_id)
+    if request.method == 'POST':
+        if apply_order(TestSuiteCase, request.form.getlist('ids', type=int), test_suite_id=testsuite_id):
+            db.session.commit()
+            return redirect(url_for('testsuite.detail', testsuite_id=testsuite_id))
+        flash('The test suite changed since the page was loaded. Please try again.')
+    tscs = db.session.execute(db.select(TestSuiteCase).filter_by(test_suite_id=testsuite_id).order_by(TestSuiteCase.order.asc()).options(db.joinedload(TestSuiteCase.test_case))).scalars().all()
+    return render_template('testsuite/reorder.html', testsuite=testsuite, tscs=tscs)
+
+@bp.route('/<int:testsuite_id>/analytics')
+@perm_to_view_required
+@conditional(analytics_version)
+def analytics(testsuite_id):
+    testsuite = db.get_or_404(TestSuite, testsuite_id)
+    history = suite_history(testsuite.id)
+    metrics = history.metrics
+    start = request.args.get('cursor', 0, type=int)
+    indexes = history.flaky_order(metrics)[start:start + PAGE_SIZE]
+    rows = metric_rows(history, metrics, indexes, history.matrix(ANALYTICS_RECENT_RUNS))
+    next_cursor = str(start + PAGE_SIZE) if start + PAGE_SIZE < len(history.case_ids) else None
+    return render_template('testsuite/analytics.html', testsuite=testsuite, rows=rows, summary=history.summary(metrics), next_cursor=next_cursor)
+
+@bp.route('/<int:testsuite_id>/analytics/export')
+@perm_to_view_required
+@conditional(analytics_version)
+def export_analytics(testsuite_id):
+    testsuite = db.get_or_404(TestSuite, testsuite_id)
+    history = suite_history(testsuite.id)
+    metrics = history.metrics
+    rows = metric_rows(history, metrics, history.flaky_order(metrics))
+    filename = f"analytics_{testsuite.name.casefold()}"
+    if request.args.get('format') == 'json':
+        body = json.dumps({'testsuite': testsuite.name, **history.summary(metrics), 'testcases': rows}, default=str)
+        return Response(body, mimetype='application/json', headers={"Content-Disposition": f"attachment; filename={filename}.json"})
+    compress = request.args.get('compress') == 'gzip'
+    filename += '.csv.gz' if compress else '.csv'
+    csv_rows = [ANALYTICS_COLUMNS, *(tuple(row[column] for column in ANALYTICS_COLUMNS) for row in rows)]
+    return Response(
+        stream_with_context(iter_encoded(iter_csv(csv_rows), compress)),
+        mimetype='application/gzip' if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
@@ -0,0 +1,196 @@
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import math
+import re
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.orm import Session
+from db import db, change_version, version_statement, project_versions, Requirement, TestCase, Bug
+from utils import LRUCache
+
+SEARCH_MODELS = {
+    'requirement': (Requirement, ('title', 'description')),
+    'testcase': (TestCase, ('title', 'preconditions', 'steps', 'expected_result')),
+    'bug': (Bug, ('title', 'description'))
+}
+SEARCH_INDEX_TTL = 300
+SUGGEST_FIELDS = {
+    'requirement': ('title',),
+    'testcase': ('title', 'preconditions', 'expected_result')
+}
+SUGGEST_LIMIT = 10
+SUGGEST_CACHE_SIZE = 256
+SUGGEST_CACHE_TTL = 60
+suggest_cache = LRUCache(SUGGEST_CACHE_SIZE, SUGGEST_CACHE_TTL)
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').casefold())
+
+def document_text(obj, fields):
+    return ' '.join(getattr(obj, field) or '' for field in fields)
+
+def model_kind(obj):
+    for kind, (model, fields) in SEARCH_MODELS.items():
+        if isinstance(obj, model):
+            return kind, fields
+    return None, None
+
+class InvertedIndex:
+    def __init__(self, version=None):
+        self.postings = {}
+        self.documents = {}
+        self.version = version
+        self.built_at = time.monotonic()
+
+    def add(self, key, text):
+        self.remove(key)
+        terms = Counter(tokenize(text))
+        if not terms:
+            return
+        self.documents[key] = (terms, sum(terms.values()))
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[key] = count
+
+    def remove(self, key):
+        terms, _ = self.documents.pop(key, (None, 0))
+        for term in terms or ():
+            documents = self.postings[term]
+            del documents[key]
+            if not documents:
+                del self.postings[term]
+
+    def search(self, query, kinds, limit):
+        scores = {}
+        total = len(self.documents) or 1
+        for term in set(tokenize(query)):
+            documents = self.postings.get(term, {})
+            if not documents:
+                continue
+            idf = math.log(1 + total / len(documents))
+            for key, count in documents.items():
+                if key[0] in kinds:
+                    scores[key] = scores.get(key, 0) + count * idf / math.sqrt(self.documents[key][1])
+        return heapq.nlargest(limit, ((score, key) for key, score in scores.items()), key=lambda item: (item[0], -item[1][1]))
+
+project_indexes = {}
+indexes_lock = threading.Lock()
+
+def index_version(project_id):
+    return change_version(*project_versions(project_id, *(model for model, _ in SEARCH_MODELS.values())))
+
+def committed_index_version(project_id):
+    with db.engine.connect() as connection:
+        return tuple(connection.execute(version_statement(*project_versions(project_id, *(model for model, _ in SEARCH_MODELS.values())))).one())
+
+def build_index(project_id, version=None):
+    index = InvertedIndex(version)
+    for kind, (model, fields) in SEARCH_MODELS.items():
+        rows = db.session.execute(
+            db.select(model.id, *(getattr(model, field) for field in fields)).filter_by(project_id=project_id)
+            .execution_options(yield_per=1000)
+        )
+        for row in rows:
+            index.add((kind, row[0]), ' '.join(value or '' for value in row[1:]))
+    return index
+
+def project_index(project_id):
+    version = index_version(project_id)
+    with indexes_lock:
+        index = project_indexes.get(project_id)
+    if index is None or index.version != version or index.built_at + SEARCH_INDEX_TTL < time.monotonic():
+        index = build_index(project_id, version)
+        with indexes_lock:
+            project_indexes[project_id] = index
+    return index
+
+def uses_fulltext():
+    return db.engine.dialect.name in ('mysql', 'mariadb')
+
+def fulltext_search(project_id, query, kinds, offset, limit):
+    selects = []
+    for kind in kinds:
+        model, fields = SEARCH_MODELS[kind]
+        score = match(*(getattr(model, field) for field in fields), against=query)
+        selects.append(
+            db.select(db.literal(kind).label('kind'), model.id.label('id'), score.label('score'))
+            .filter(model.project_id == project_id, score > 0)
+        )
+    results = db.union_all(*selects).subquery()
+    rows = db.session.execute(
+        db.select(results.c.kind, results.c.id, results.c.score).order_by(results.c.score.desc(), results.c.id.asc()).offset(offset).limit(limit)
+    ).all()
+    return [(kind, id, score) for kind, id, score in rows]
+
+def search(project_id, query, kinds=None, offset=0, limit=20):
+    kinds = [kind for kind in SEARCH_MODELS if kind in (kinds or SEARCH_MODELS)]
+    if not tokenize(query) or not kinds:
+        return []
+    if uses_fulltext():
+        return fulltext_search(project_id, query, kinds, offset, limit)
+    index = project_index(project_id)
+    with indexes_lock:
+        hits = index.search(query, kinds, offset + limit)
+    return [(kind, id, score) for score, (kind, id) in hits[offset:]]
+
+def build_suggestions(project_id, kind, field):
+    column = getattr(SEARCH_MODELS[kind][0], field)
+    rows = db.session.execute(
+        db.select(column, db.func.count()).filter(SEARCH_MODELS[kind][0].project_id == project_id, column != '').group_by(column)
+    ).all()
+    values = sorted((value.casefold(), -count, value) for value, count in rows if value)
+    return [value[0] for value in values], [(value[1], value[2]) for value in values]
+
+def suggest(project_id, kind, field, prefix, limit=SUGGEST_LIMIT):
+    key = (project_id, kind, field)
+    suggestions = suggest_cache.get(key)
+    if suggestions is None:
+        suggestions = build_suggestions(project_id, kind, field)
+        suggest_cache.set(key, suggestions)
+    keys, values = suggestions
+    prefix = prefix.casefold()
+    start = bisect_left(keys, prefix)
+    end = bisect_left(keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+    return [value for _, value in heapq.nsmallest(limit, values[start:end])]
+
+@event.listens_for(Session, 'after_flush')
+def collect_changes(session, flush_context):
+    changes = session.info.setdefault('search_changes', {})
+    for obj in (*session.new, *session.dirty):
+        kind, fields = model_kind(obj)
+        if kind:
+            changes[(kind, obj.id)] = (obj.project_id, document_text(obj, fields))
+    for obj in session.deleted:
+        kind, fields = model_kind(obj)
+        if kind:
+            changes[(kind, obj.id)] = (obj.project_id, None)
+
+@event.listens_for(Session, 'after_commit')
+def apply_changes(session):
+    changes = session.info.pop('search_changes', {})
+    for (kind, _), (project_id, _) in changes.items():
+        for field in SUGGEST_FIELDS.get(kind, ()):
+            suggest_cache.pop((project_id, kind, field))
+    patched = set()
+    with indexes_lock:
+        for key, (project_id, text) in changes.items():
+            index = project_indexes.get(project_id)
+            if index is None:
+                continue
+            if text is None:
+                index.remove(key)
+            else:
+                index.add(key, text)
+            patched.add(project_id)
+    for project_id in patched:
+        version = committed_index_version(project_id)
+        with indexes_lock:
+            if project_id in project_indexes:
+                project_indexes[project_id].version = version
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('search_changes', None)
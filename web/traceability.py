@@ -0,0 +1,112 @@
+from array import array
+from db import db, change_version, project_versions, Requirement, RequirementTestCase, TestCase, TestRun, TestResult
+from utils import LRUCache, code_with_prefix
+
+STATUS_CODES = {'pass': 1, 'fail': 2, 'skip': 3}
+STATUS_NAMES = ('not run', 'pass', 'fail', 'skip')
+MATRIX_CACHE_SIZE = 16
+MATRIX_CACHE_TTL = 60
+matrix_cache = LRUCache(MATRIX_CACHE_SIZE, MATRIX_CACHE_TTL)
+
+def iter_bits(bits):
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+class TraceabilityMatrix:
+    def __init__(self, requirements, testcases, links, statuses):
+        self.requirements = requirements
+        self.testcases = testcases
+        self.links = links
+        self.statuses = statuses
+        self.executed = 0
+        self.passed = 0
+        for position, status in enumerate(statuses):
+            if status:
+                self.executed |= 1 << position
+            if status == STATUS_CODES['pass']:
+                self.passed |= 1 << position
+
+    def coverage(self, index):
+        links = self.links[index]
+        linked = links.bit_count()
+        passed = (links & self.passed).bit_count()
+        return {
+            'linked': linked,
+            'executed': (links & self.executed).bit_count(),
+            'passed': passed,
+            'percent': round(passed / linked * 100, 2) if linked else 0
+        }
+
+    def row(self, index):
+        id, order, title = self.requirements[index]
+        testcases = [
+            {'id': self.testcases[position][0], 'code': code_with_prefix('TC', self.testcases[position][1]), 'title': self.testcases[position][2], 'status': STATUS_NAMES[self.statuses[position]]}
+            for position in iter_bits(self.links[index])
+        ]
+        return {'id': id, 'code': code_with_prefix('REQ', order), 'title': title, 'coverage': self.coverage(index), 'testcases': testcases}
+
+    def summary(self):
+        covered = sum(1 for links in self.links if links)
+        linked = 0
+        for links in self.links:
+            linked |= links
+        return {
+            'requirements': len(self.requirements),
+            'testcases': len(self.testcases),
+            'uncovered': len(self.requirements) - covered,
+            'percent_covered': round(covered / len(self.requirements) * 100, 2) if self.requirements else 0,
+            'untraced_testcases': len(self.testcases) - linked.bit_count()
+        }
+
+    def iter_rows(self):
+        yield ('Requirement', 'Title', 'Coverage %', *(code_with_prefix('TC', order) for _, order, _ in self.testcases))
+        for index, (_, order, title) in enumerate(self.requirements):
+            cells = [''] * len(self.testcases)
+            for position in iter_bits(self.links[index]):
+                cells[position] = STATUS_NAMES[self.statuses[position]]
+            yield (code_with_prefix('REQ', order), title, self.coverage(index)['percent'], *cells)
+
+def matrix_version(project_id):
+    return change_version(*project_versions(project_id, Requirement, TestCase, RequirementTestCase, TestRun))
+
+def load_matrix(project_id):
+    requirements = db.session.execute(
+        db.select(Requirement.id, Requirement.order, Requirement.title).filter_by(project_id=project_id).order_by(Requirement.order.asc())
+    ).tuples().all()
+    testcases = db.session.execute(
+        db.select(TestCase.id, TestCase.order, TestCase.title).filter_by(project_id=project_id).order_by(TestCase.order.asc())
+    ).tuples().all()
+    requirement_positions = {id: position for position, (id, _, _) in enumerate(requirements)}
+    testcase_positions = {id: position for position, (id, _, _) in enumerate(testcases)}
+    links = [0] * len(requirements)
+    rows = db.session.execute(
+        db.select(RequirementTestCase.requirement_id, RequirementTestCase.test_case_id).join(Requirement).filter(Requirement.project_id == project_id)
+    )
+    for requirement_id, test_case_id in rows:
+        if test_case_id in testcase_positions:
+            links[requirement_positions[requirement_id]] |= 1 << testcase_positions[test_case_id]
+    latest = (
+        db.select(TestResult.test_case_id, db.func.max(TestResult.executed_at).label('executed_at'))
+        .join(TestCase).filter(TestCase.project_id == project_id, TestResult.executed_at.is_not(None))
+        .group_by(TestResult.test_case_id).subquery()
+    )
+    statuses = array('b', bytes(len(testcases)))
+    rows = db.session.execute(
+        db.select(TestResult.test_case_id, TestResult.status)
+        .join(latest, db.and_(TestResult.test_case_id == latest.c.test_case_id, TestResult.executed_at == latest.c.executed_at))
+    )
+    for test_case_id, status in rows:
+        if test_case_id in testcase_positions and status in STATUS_CODES:
+            statuses[testcase_positions[test_case_id]] = STATUS_CODES[status]
+    return TraceabilityMatrix(requirements, testcases, links, statuses)
+
+def project_matrix(project_id):
+    version = matrix_version(project_id)
+    cached = matrix_cache.get(project_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    matrix = load_matrix(project_id)
+    matrix_cache.set(project_id, (version, matrix))
+    return matrix
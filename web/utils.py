@@ -1,7 +1,12 @@
+from collections import OrderedDict
+from collections.abc import Iterator
 from datetime import datetime, timedelta, timezone
-from io import StringIO, BytesIO
+import codecs
 import csv
 import json
+import threading
+import time
+import zlib
 from smtplib import SMTP
 from email.mime.text import MIMEText
 import jwt
@@ -42,20 +47,156 @@ def database_uri(database="example", user="root", psswd_file=None, host="db", po
         password = f.read().strip()
     return f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset=utf8mb4"
 
-def create_csv(data):
-    output = StringIO()
-    writer = csv.writer(output)
-    for row in data:
-        writer.writerow(row)
-    return output.getvalue()
-
-def create_json(data):
-    json_data = json.dumps(data, indent=4)
-    buffer = BytesIO()
-    buffer.write(json_data.encode('utf-8'))
-    buffer.seek(0)
-    return buffer
-
-def import_json(file):
-    data = file.read().decode('utf-8')
-    return json.loads(data)
+EXPORT_CHUNK_SIZE = 1000
+
+class LRUCache:
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value, expires_at = self.items[key]
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + self.ttl if self.ttl else None)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+class EchoWriter:
+    def write(self, value):
+        return value
+
+def iter_csv(rows):
+    writer = csv.writer(EchoWriter())
+    for row in rows:
+        yield writer.writerow(row)
+
+def iter_encoded(chunks, compress=False, buffer_size=64 * 1024):
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            data = ''.join(buffer).encode('utf-8')
+            buffer, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = ''.join(buffer).encode('utf-8')
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+def iter_json_object(pairs, indent=None, level=0):
+    item_separator, key_separator = (',', ': ') if indent is not None else (',', ':')
+    newline = '\n' + ' ' * indent * (level + 1) if indent is not None else ''
+    closing = '\n' + ' ' * indent * level if indent is not None else ''
+    empty = True
+    yield '{'
+    for key, value in pairs:
+        yield ('' if empty else item_separator) + newline + json.dumps(key) + key_separator
+        empty = False
+        if isinstance(value, Iterator):
+            yield from iter_json_object(value, indent, level + 1)
+        else:
+            encoded = json.dumps(value, indent=indent, separators=(item_separator, key_separator))
+            yield encoded.replace('\n', newline) if newline else encoded
+    yield '}' if empty else closing + '}'
+
+class JSONStreamReader:
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += self.decoder.decode(chunk, final=not chunk)
+        self.eof = not chunk
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expecting '{char}' at character {self.pos}.")
+        self.pos += 1
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def iter_members(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError(f"Expecting property name at character {self.pos}.")
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f"Expecting ',' delimiter at character {self.pos - 1}.")
+
+def iter_json_records(stream, sections):
+    reader = JSONStreamReader(stream)
+    for key in reader.iter_members():
+        if key in sections and reader.peek() == '{':
+            for code in reader.iter_members():
+                yield key, code, reader.read_value()
+        else:
+            yield key, None, reader.read_value()
+    if reader.peek():
+        raise ValueError(f"Extra data at character {reader.pos}.")